@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+# Rough timings of the painter on large scenes. A display is needed.
+# Usage: benchmark.py [name ...]   (all the benchmarks by default)
+
+import math
+import random
+import sys
+import time
+import tkinter as tk
+
+import painter
+
+
+def scribble(p, strokes, segments=50):
+    # Fill the active page with pen strokes the way draw_motion creates them
+    random.seed(0)
+    width = max(p.c.winfo_width(), 200)
+    height = max(p.c.winfo_height(), 200)
+    for _ in range(strokes):
+        x, y = random.uniform(0, width), random.uniform(0, height)
+        tag = "manual-start"
+        for _ in range(segments):
+            nx, ny = x + random.uniform(-6, 6), y + random.uniform(-6, 6)
+            p.create(
+                "line",
+                x,
+                y,
+                nx,
+                ny,
+                width=p.line_width,
+                fill=p.color,
+                capstyle=tk.ROUND,
+                smooth=tk.TRUE,
+                splinesteps=36,
+                tags=p.item_tags(tag),
+            )
+            x, y, tag = nx, ny, "manual"
+
+
+def bench_pages(p):
+    """Switch back and forth between two pages of 20000 items each."""
+    p.wipe_canvas()
+    scribble(p, 400)
+    p.pages.append(())
+    p.goto_page(1)
+    scribble(p, 400)
+    p.root.update_idletasks()
+    worst = 0.0
+    for index in [0, 1, 0, 1, 0]:
+        start = time.perf_counter()
+        p.goto_page(index)
+        p.root.update_idletasks()
+        worst = max(worst, time.perf_counter() - start)
+    print("pages: worst switch {:.1f} ms for {} items (budget {:.0f} ms)".format(
+        worst * 1000, len(p.c.find_all()), p.PAGE_SWITCH_BUDGET * 1000))
+    return worst <= p.PAGE_SWITCH_BUDGET
+
+
+class Event:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+
+def bench_select(p):
+    """Select, move, scale and recolor a quarter of a 20000 item scene."""
+    p.wipe_canvas()
+    scribble(p, 400)
+    p.select_tool("select")
+    width, height = p.c.winfo_width(), p.c.winfo_height()
+    timings = {}
+    start = time.perf_counter()
+    p.draw_start(Event(0, 0))
+    p.draw_motion(Event(width // 2, height // 2))
+    p.draw_release(Event(width // 2, height // 2))
+    p.root.update_idletasks()
+    timings["select"] = time.perf_counter() - start
+    start = time.perf_counter()
+    p.draw_start(Event(width // 4, height // 4))
+    for step in range(1, 21):
+        p.draw_motion(Event(width // 4 + step, height // 4 + step))
+    p.draw_release(Event(width // 4 + 20, height // 4 + 20))
+    p.root.update_idletasks()
+    timings["move"] = time.perf_counter() - start
+    start = time.perf_counter()
+    p.scale_selection(1.25)
+    p.root.update_idletasks()
+    timings["scale"] = time.perf_counter() - start
+    start = time.perf_counter()
+    p.recolor_selection("#3498db")
+    p.root.update_idletasks()
+    timings["recolor"] = time.perf_counter() - start
+    selected = len(p.selection)
+    print("select: {} of {} items, {}".format(
+        selected, len(p.c.find_all()),
+        ", ".join("{} {:.1f} ms".format(name, value * 1000) for name, value in timings.items())))
+    p.select_tool("pen")
+    p.clear_selection()
+    # Selecting nothing would make the timings meaningless
+    return selected > 0 and max(timings.values()) <= 0.1
+
+
+def bench_view(p):
+    """Pan and zoom over a 20000 item scene, most of it out of the viewport."""
+    p.wipe_canvas()
+    p.set_view(0.0, 0.0, 1.0)
+    scribble(p, 400)
+    p.root.update_idletasks()
+    width, height = p.c.winfo_width(), p.c.winfo_height()
+    worst = 0.0
+    for step in range(20):
+        start = time.perf_counter()
+        p.zoom_at(width // 2, height // 2, p.ZOOM_STEP)
+        p.root.update_idletasks()
+        worst = max(worst, time.perf_counter() - start)
+    p.pan_start(Event(0, 0))
+    for step in range(1, 21):
+        start = time.perf_counter()
+        p.pan_motion(Event(step * 10, step * 5))
+        p.root.update_idletasks()
+        worst = max(worst, time.perf_counter() - start)
+    p.pan_end(None)
+    print("view: worst frame {:.1f} ms, {} of {} items on screen".format(
+        worst * 1000, len(p.onscreen), len(p.c.find_all())))
+    p.set_view(0.0, 0.0, 1.0)
+    p.root.update_idletasks()
+    return worst <= 0.1
+
+
+def redraw_time(p, frames=10):
+    start = time.perf_counter()
+    for step in range(frames):
+        p.c.move("all", 1 if step % 2 else -1, 0)
+        p.root.update_idletasks()
+    return (time.perf_counter() - start) / frames
+
+
+def distance_to_polyline(x, y, coords):
+    best = float("inf")
+    for idx in range(0, len(coords) - 2, 2):
+        x0, y0, x1, y1 = coords[idx:idx + 4]
+        dx, dy = x1 - x0, y1 - y0
+        t = ((x - x0) * dx + (y - y0) * dy) / (dx * dx + dy * dy) if dx or dy else 0.0
+        t = max(0.0, min(1.0, t))
+        best = min(best, math.hypot(x - x0 - t * dx, y - y0 - t * dy))
+    return best
+
+
+def bench_lod(p):
+    """Redraw 400 pen strokes, as the old smoothed segments and once merged on release."""
+    p.wipe_canvas()
+    scribble(p, 400)
+    p.root.update_idletasks()
+    segments = redraw_time(p)
+    segments_bbox = p.c.bbox("all")
+    # The same strokes, drawn through the pen tool
+    p.wipe_canvas()
+    random.seed(0)
+    width = max(p.c.winfo_width(), 200)
+    height = max(p.c.winfo_height(), 200)
+    strokes = []
+    for _ in range(400):
+        x, y = random.uniform(0, width), random.uniform(0, height)
+        points = [(x, y)]
+        p.draw_start(Event(x, y))
+        for _ in range(50):
+            x, y = x + random.uniform(-6, 6), y + random.uniform(-6, 6)
+            points.append((x, y))
+            p.draw_motion(Event(x, y))
+        p.draw_release(Event(x, y))
+        strokes.append(points)
+    p.root.update_idletasks()
+    merged = redraw_time(p)
+    # Same look: every drawn point stays on its merged stroke, the drawing covers the same area
+    items = p.c.find_all()
+    drift = max(
+        distance_to_polyline(x, y, p.c.coords(item)) for item, points in zip(items, strokes) for x, y in points
+    )
+    merged_bbox = p.c.bbox("all")
+    shift = max(abs(a - b) for a, b in zip(segments_bbox, merged_bbox))
+    print("lod: redraw {:.1f} ms as segments, {:.1f} ms merged ({} items), drift {:.2f} px, bbox shift {} px".format(
+        segments * 1000, merged * 1000, len(items), drift, shift))
+    # The moves by redraw_time() cancel out, the simplification tolerance is half a pixel
+    return merged <= segments and drift <= 0.5 + 1e-6 and shift <= 1
+
+
+BENCHMARKS = {
+    "pages": bench_pages,
+    "select": bench_select,
+    "view": bench_view,
+    "lod": bench_lod,
+}
+
+
+if __name__ == "__main__":
+    root = tk.Tk()
+    p = painter.Painter(root)
+    root.update()
+    ok = True
+    for name in sys.argv[1:] or list(BENCHMARKS):
+        ok = BENCHMARKS[name](p) and ok
+    root.destroy()
+    sys.exit(0 if ok else 1)
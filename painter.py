@@ -1,18 +1,28 @@
 #!/usr/bin/env python3
 
-import wmctrl
-import Xlib.display
-import json
-import math
-import queue
-import threading
 import time
-import tkinter as tk
-import tkinter.font as tkFont
 
-from functools import partial
-from tkinter.colorchooser import askcolor
+STARTUP = {"start": time.perf_counter()}
 
+# The imports below are timed for --startup-time, hence after STARTUP
+import base64  # noqa: E402
+import collections  # noqa: E402
+import heapq  # noqa: E402
+import json  # noqa: E402
+import math  # noqa: E402
+import os  # noqa: E402
+import queue  # noqa: E402
+import struct  # noqa: E402
+import threading  # noqa: E402
+import traceback  # noqa: E402
+import tkinter as tk  # noqa: E402
+import tkinter.font as tkFont  # noqa: E402
+import zlib  # noqa: E402
+
+from functools import partial  # noqa: E402
+from tkinter.colorchooser import askcolor  # noqa: E402
+
+STARTUP["imports"] = time.perf_counter()
 
 the_queue = queue.Queue()
 
@@ -26,10 +36,45 @@ DEFAULT = {
     "fill": None,
     "separate": False,
     "following": None,
-    "ratio": None
+    "ratio": None,
+    "ink": "permanent",
+    "ink_lifetime": 5.0,
+    "ink_fade": 1.0,
+    "layers": ["base", "overlay"],
+    "layer": "base",
+    "session": "session.json",
+    "recognize": False,
+    "stamps": [],
+    "stamp_cache_mb": 32,
+    "tools": {},
 }
 
 
+TCL_ESCAPES = str.maketrans({char: "\\" + char for char in '\\[]{}$"; '})
+TCL_ESCAPES.update(str.maketrans({"\n": "\\n", "\t": "\\t"}))
+
+
+def tcl_word(value):
+    # Quote a value so that it reads back as a single word in a Tcl script
+    if isinstance(value, (tuple, list)):
+        value = " ".join(str(element) for element in value)
+    value = str(value)
+    if not value:
+        return "{}"
+    return value.translate(TCL_ESCAPES)
+
+
+def tcl_create(widget, kind, coords, options):
+    # Same command as widget.create_<kind>(*coords, **options), as Tcl source
+    words = [widget, "create", kind]
+    words.extend(str(coord) for coord in coords)
+    for key, value in options.items():
+        if value is not None:
+            words.append("-" + key)
+            words.append(tcl_word(value))
+    return " ".join(words)
+
+
 class StatusBar(tk.Frame):
     def __init__(self, master):
         super().__init__(master)
@@ -40,6 +85,11 @@ class StatusBar(tk.Frame):
         self.strings["fill"] = tk.StringVar()
         self.strings["width"] = tk.StringVar()
         self.strings["alpha"] = tk.StringVar()
+        self.strings["ink"] = tk.StringVar()
+        self.strings["page"] = tk.StringVar()
+        self.strings["recognize"] = tk.StringVar()
+        self.strings["stamp"] = tk.StringVar()
+        self.strings["view"] = tk.StringVar()
         self.strings["win_position"] = tk.StringVar()
         self.strings["win_size"] = tk.StringVar()
         self.labels = {}
@@ -56,6 +106,9 @@ class StatusBar(tk.Frame):
             # label.pack(fill=tk.X)
             label.grid(row=0, column=idx)
             self.labels[var] = label
+        self.frame_layers = tk.Frame(self)
+        self.frame_layers.grid(row=1, column=0, columnspan=len(self.strings), sticky=tk.W)
+        self.layer_labels = {}
         self.pack()
 
     def update_status(self, **kwargs):
@@ -73,10 +126,39 @@ class StatusBar(tk.Frame):
             self.strings["width"].set("width: {}".format(kwargs["width"]))
         if "alpha" in kwargs.keys():
             self.strings["alpha"].set("opacity: {}".format(kwargs["alpha"]))
+        if "ink" in kwargs.keys():
+            self.strings["ink"].set("ink: {}".format(kwargs["ink"]))
+        if "recognize" in kwargs.keys():
+            self.strings["recognize"].set("shapes: {}".format("on" if kwargs["recognize"] else "off"))
+        if "stamp" in kwargs.keys():
+            self.strings["stamp"].set("stamp: {}".format(os.path.basename(kwargs["stamp"]) if kwargs["stamp"] else "none"))
+        if "view" in kwargs.keys():
+            self.strings["view"].set("view: ({:.0f}, {:.0f}) {:.0f}%".format(
+                kwargs["view"][0], kwargs["view"][1], kwargs["view"][2] * 100))
+        if "page" in kwargs.keys():
+            self.strings["page"].set("page: {}/{}".format(kwargs["page"][0], kwargs["page"][1]))
         if "win_position" in kwargs.keys():
             self.strings["win_position"].set("({}, {})".format(kwargs["win_position"][0], kwargs["win_position"][1]))
         if "win_size" in kwargs.keys():
             self.strings["win_size"].set("({}, {})".format(kwargs["win_size"][0], kwargs["win_size"][1]))
+        if "layers" in kwargs.keys():
+            self.update_layers(kwargs["layers"])
+
+    def update_layers(self, layers):
+        for name in list(self.layer_labels):
+            if name not in [layer[0] for layer in layers]:
+                self.layer_labels.pop(name).destroy()
+        for idx, (name, active, visible) in enumerate(layers):
+            if name not in self.layer_labels:
+                label = tk.Label(self.frame_layers, bd=1, anchor=tk.W, font=("arial", 10, "normal"), padx=5)
+                label.bind("<Button-1>", lambda event, name=name: the_queue.put("layer {}".format(name)))
+                self.layer_labels[name] = label
+            self.layer_labels[name].configure(
+                text="{} {}{}".format(idx + 1, name, "" if visible else " (hidden)"),
+                relief=tk.SUNKEN if active else tk.RAISED,
+                fg="black" if visible else "gray",
+            )
+            self.layer_labels[name].grid(row=0, column=idx)
 
 
 class MenuBar(tk.Frame):
@@ -96,17 +178,27 @@ class MenuBar(tk.Frame):
         "#95a5a6",
     ]
 
-    def __init__(self, master):
+    def __init__(self, master, deferred=False):
         super().__init__(master)
 
         # Some variables
         self.text_input = tk.StringVar(self)
         self.fill_status = tk.IntVar(self)
         self.separate_status = tk.IntVar(self)
+        self.ink_status = tk.IntVar(self)
+        self.recognize_status = tk.IntVar(self)
 
         self.buttons = {}
+        self.built = False
+        self.pending = {}
+
+        # When deferred, the owner calls build() once the canvas is on screen
+        if not deferred:
+            self.build()
 
-        # Build the interface
+    def build(self):
+        if self.built:
+            return
         self.buttons["pen"] = tk.Button(self, text="pen", command=self.use_pen)
         self.buttons["pen"].grid(row=0, column=0)
 
@@ -128,6 +220,15 @@ class MenuBar(tk.Frame):
         self.buttons["eraser"] = tk.Button(self, text="eraser", command=self.use_eraser)
         self.buttons["eraser"].grid(row=0, column=6)
 
+        self.buttons["laser"] = tk.Button(self, text="laser", command=self.use_laser)
+        self.buttons["laser"].grid(row=0, column=18)
+
+        self.buttons["select"] = tk.Button(self, text="select", command=self.use_select)
+        self.buttons["select"].grid(row=0, column=19)
+
+        self.buttons["stamp"] = tk.Button(self, text="stamp", command=self.use_stamp)
+        self.buttons["stamp"].grid(row=0, column=20)
+
         self.choose_size_button = tk.Scale(self, from_=1, to=10, orient=tk.HORIZONTAL, command=self.update_width)
         self.choose_size_button.set(DEFAULT["width"])
         self.choose_size_button.grid(row=0, column=7)
@@ -167,15 +268,35 @@ class MenuBar(tk.Frame):
         self.buttons["text"] = tk.Button(self, text="text", command=self.use_text)
         self.buttons["text"].grid(row=0, column=15)
 
+        self.buttons["ink"] = tk.Checkbutton(
+            self, text="disappearing ink", variable=self.ink_status, command=self.toggle_ink
+        )
+        self.buttons["ink"].grid(row=0, column=16)
+
+        self.buttons["recognize"] = tk.Checkbutton(
+            self, text="recognize shapes", variable=self.recognize_status, command=self.toggle_recognize
+        )
+        self.buttons["recognize"].grid(row=0, column=17)
+
         self.active_button = self.buttons["pen"]
+        self.built = True
+        self.update_status(**self.pending)
+        self.pending.clear()
 
     def update_status(self, **kwargs):
+        if not self.built:
+            self.pending.update(kwargs)
+            return
         if "color" in kwargs.keys():
             self.buttons["color"].configure(background=kwargs["color"])
         if "bg_color" in kwargs.keys():
             self.buttons["bg_color"].configure(background=kwargs["bg_color"])
         if "mode" in kwargs.keys():
-            self.activate_button(self.buttons[kwargs["mode"]])
+            # Plugin tools have no button: none is shown as active then
+            if kwargs["mode"] in self.buttons:
+                self.activate_button(self.buttons[kwargs["mode"]])
+            else:
+                self.active_button.config(relief=tk.RAISED)
         if "fill" in kwargs.keys():
             self.fill_status.set(1 if kwargs["fill"] else 0)
         if "width" in kwargs.keys():
@@ -184,6 +305,10 @@ class MenuBar(tk.Frame):
             self.choose_alpha_button.set(kwargs["alpha"])
         if "separate" in kwargs.keys() :
             self.separate_status.set(1 if kwargs["separate"] else 0)
+        if "ink" in kwargs.keys():
+            self.ink_status.set(1 if kwargs["ink"] == "disappearing" else 0)
+        if "recognize" in kwargs.keys():
+            self.recognize_status.set(1 if kwargs["recognize"] else 0)
 
     def use_pen(self):
         self.activate_button(self.buttons["pen"])
@@ -221,6 +346,18 @@ class MenuBar(tk.Frame):
         self.activate_button(self.buttons["eraser"])
         the_queue.put("mode eraser")
 
+    def use_laser(self):
+        self.activate_button(self.buttons["laser"])
+        the_queue.put("mode laser")
+
+    def use_select(self):
+        self.activate_button(self.buttons["select"])
+        the_queue.put("mode select")
+
+    def use_stamp(self):
+        self.activate_button(self.buttons["stamp"])
+        the_queue.put("mode stamp")
+
     def use_text(self):
         self.activate_button(self.buttons["text"])
         the_queue.put("text {}".format(self.text_input.get()))
@@ -252,32 +389,751 @@ class MenuBar(tk.Frame):
         self.buttons["color"].configure(background=color)
         the_queue.put("color {}".format(color))
 
+    def toggle_ink(self):
+        the_queue.put("ink {}".format("disappearing" if self.ink_status.get() else "permanent"))
+
+    def toggle_recognize(self):
+        the_queue.put("recognize {}".format(self.recognize_status.get()))
+
 class Commander(tk.Frame):
-    def __init__(self, root=None):
+    def __init__(self, root=None, deferred=False):
         super().__init__(root)
         self.root = root
         self.root.title("DrawOnStream - Commander")
         self.font = tkFont.Font(family="Helvetica", size=20)
         self.text_input = tk.StringVar(self.root)
-        self.menu_bar = MenuBar(self.root)
+        self.menu_bar = MenuBar(self.root, deferred=deferred)
         self.menu_bar.pack(side=tk.TOP, fill=tk.X)
         self.status_bar = StatusBar(self.root)
         self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
 
 
+class PipeQueue:
+    """Stands for the_queue in the Commander process: commands go to the painter through a pipe."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def put(self, message):
+        self.conn.send(message)
+
+
+class RemotePanel:
+    """Stands for the menu or status bar of the Commander process, in the painter."""
+
+    def __init__(self, name, outbox):
+        self.name = name
+        self.outbox = outbox
+
+    def build(self):
+        pass
+
+    def update_status(self, **kwargs):
+        # Never blocks: a thread sends the updates, even while the Commander sits in a dialog
+        self.outbox.put((self.name, kwargs))
+
+
+def forward_commands(conn):
+    # Painter side: commands from the Commander process join the local queue
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            the_queue.put("commander lost")
+            return
+        the_queue.put(message)
+
+
+def forward_status(outbox, conn):
+    # Painter side: status updates waiting together are merged and sent at once
+    while True:
+        updates = {}
+        name, kwargs = outbox.get()
+        updates.setdefault(name, {}).update(kwargs)
+        while not outbox.empty():
+            name, kwargs = outbox.get_nowait()
+            updates.setdefault(name, {}).update(kwargs)
+        try:
+            conn.send(updates)
+        except (BrokenPipeError, OSError):
+            return
+
+
+def receive_status(conn, inbox):
+    # Commander side: None tells the Tk loop that the painter is gone
+    while True:
+        try:
+            inbox.put(conn.recv())
+        except (EOFError, OSError):
+            inbox.put(None)
+            return
+
+
+def run_commander(commands, status):
+    # Entry point of the Commander process, with a Tk interpreter of its own
+    global the_queue
+    the_queue = PipeQueue(commands)
+    root = tk.Tk()
+    commander = Commander(root)
+    # Switching modes would need the painter to restart: not from here
+    commander.menu_bar.separate_button.grid_remove()
+    panels = {"menu": commander.menu_bar, "status": commander.status_bar}
+    inbox = queue.Queue()
+    threading.Thread(target=receive_status, args=(status, inbox), daemon=True).start()
+
+    def poll():
+        while not inbox.empty():
+            updates = inbox.get_nowait()
+            if updates is None:
+                root.destroy()
+                return
+            for name, kwargs in updates.items():
+                panels[name].update_status(**kwargs)
+        root.after(20, poll)
+
+    root.protocol("WM_DELETE_WINDOW", lambda: the_queue.put("quit"))
+    poll()
+    root.mainloop()
+
+
+class ExpiryScheduler:
+    """Deletes tagged canvas items once their deadline is reached.
+
+    Deadlines live in a min-heap and a single `after` timer is armed for the
+    earliest one, so the cost does not depend on how many items are pending.
+    """
+
+    FADE_STIPPLES = ["gray75", "gray50", "gray25", "gray12"]
+
+    def __init__(self, widget, on_expire):
+        self.widget = widget
+        self.on_expire = on_expire
+        self.heap = []
+        self.counter = 0
+        self.timer = None
+        self.timer_deadline = None
+
+    def schedule(self, tag, lifetime, fade=0.0, outline=False):
+        now = time.monotonic()
+        fade = max(0.0, min(fade, lifetime))
+        if fade:
+            step = fade / len(self.FADE_STIPPLES)
+            for idx, stipple in enumerate(self.FADE_STIPPLES):
+                self.push(now + lifetime - fade + idx * step, tag, stipple, outline)
+        self.push(now + lifetime, tag, None, outline)
+        self.arm()
+
+    def push(self, deadline, tag, stipple, outline):
+        # The counter keeps entries with equal deadlines in insertion order
+        self.counter += 1
+        heapq.heappush(self.heap, (deadline, self.counter, tag, stipple, outline))
+
+    def arm(self):
+        if not self.heap:
+            return
+        deadline = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_deadline <= deadline:
+                return
+            self.widget.after_cancel(self.timer)
+        delay = max(0, int((deadline - time.monotonic()) * 1000))
+        self.timer = self.widget.after(delay, self.fire)
+        self.timer_deadline = deadline
+
+    def fire(self):
+        self.timer = None
+        now = time.monotonic()
+        fading = {}
+        expired = []
+        # Anything due within the next few milliseconds goes in the same batch
+        while self.heap and self.heap[0][0] <= now + 0.005:
+            _, _, tag, stipple, outline = heapq.heappop(self.heap)
+            if stipple is None:
+                expired.append(tag)
+            else:
+                fading[tag] = (stipple, outline)
+        for tag in expired:
+            fading.pop(tag, None)
+        for tag, (stipple, outline) in fading.items():
+            # Images have no stipple: stamps just vanish when they expire
+            self.widget.itemconfigure("{}&&!stamp".format(tag), stipple=stipple)
+            if outline:
+                self.widget.itemconfigure("{}&&!stamp".format(tag), outlinestipple=stipple)
+        if expired:
+            self.on_expire(expired)
+        self.arm()
+
+    def clear(self):
+        self.heap.clear()
+        if self.timer is not None:
+            self.widget.after_cancel(self.timer)
+            self.timer = None
+
+
+class RingBuffer:
+    """Fixed number of timestamped points, the oldest being overwritten first."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.xs = [0] * capacity
+        self.ys = [0] * capacity
+        self.times = [0.0] * capacity
+        self.start = 0
+        self.count = 0
+
+    def push(self, x, y, when):
+        idx = (self.start + self.count) % self.capacity
+        self.xs[idx] = x
+        self.ys[idx] = y
+        self.times[idx] = when
+        if self.count == self.capacity:
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.count += 1
+
+    def drop_older(self, when):
+        while self.count and self.times[self.start] < when:
+            self.start = (self.start + 1) % self.capacity
+            self.count -= 1
+
+    def clear(self):
+        self.count = 0
+
+    def coords(self):
+        coords = []
+        for offset in range(self.count):
+            idx = (self.start + offset) % self.capacity
+            coords.append(self.xs[idx])
+            coords.append(self.ys[idx])
+        return coords
+
+
+class StampCache:
+    """Stamp images loaded in the background, with an LRU of their scaled variants.
+
+    With Pillow, a worker thread decodes and resizes the images. Without it,
+    the worker only reads the files: Tk decodes them and scales the variants
+    (zoomed and subsampled copies) on the main thread, once per image and size.
+    Only the last few full size images are kept around to scale from.
+    """
+
+    SOURCES = 4
+
+    def __init__(self, widget, max_bytes):
+        self.widget = widget
+        self.max_bytes = max_bytes
+        self.variants = collections.OrderedDict()
+        self.used_bytes = 0
+        self.sources = collections.OrderedDict()
+        self.failed = set()
+        self.pending = set()
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = None
+        self.polling = None
+
+    def get(self, path, size):
+        key = (path, size)
+        image = self.variants.get(key)
+        if image is None:
+            self.request(path, size)
+        else:
+            self.variants.move_to_end(key)
+        return image
+
+    def request(self, path, size):
+        key = (path, size)
+        if key in self.pending or key in self.variants or path in self.failed:
+            return
+        self.pending.add(key)
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.decode, daemon=True)
+            self.worker.start()
+        self.requests.put(key)
+        if self.polling is None:
+            self.polling = self.widget.after(20, self.poll)
+
+    def decode(self):
+        # Worker thread: Tk images are only created by poll(), on the main thread
+        try:
+            from PIL import Image
+        except ImportError:
+            Image = None
+        sources = collections.OrderedDict()
+        while True:
+            path, size = self.requests.get()
+            try:
+                if path in sources:
+                    sources.move_to_end(path)
+                else:
+                    if Image is not None:
+                        sources[path] = Image.open(path).convert("RGBA")
+                    else:
+                        with open(path, "rb") as image_file:
+                            sources[path] = base64.b64encode(image_file.read())
+                    if len(sources) > self.SOURCES:
+                        sources.popitem(last=False)
+                source = sources[path]
+                if Image is not None:
+                    scale = size / max(source.size)
+                    source = source.resize(
+                        (max(1, round(source.width * scale)), max(1, round(source.height * scale))), Image.LANCZOS
+                    )
+                self.results.put((path, size, source, None))
+            except Exception as e:
+                self.results.put((path, size, None, e))
+
+    def poll(self):
+        self.polling = None
+        while not self.results.empty():
+            path, size, payload, error = self.results.get()
+            self.pending.discard((path, size))
+            if error is not None:
+                # Reported once, the path is not tried again
+                self.failed.add(path)
+                print(error)
+            elif isinstance(payload, bytes):
+                if path in self.sources:
+                    self.sources.move_to_end(path)
+                else:
+                    try:
+                        self.sources[path] = tk.PhotoImage(data=payload)
+                    except tk.TclError as e:
+                        self.failed.add(path)
+                        print(e)
+                        continue
+                    if len(self.sources) > self.SOURCES:
+                        self.sources.popitem(last=False)
+                self.add((path, size), self.scaled(self.sources[path], size))
+            else:
+                from PIL import ImageTk
+                self.add((path, size), ImageTk.PhotoImage(payload))
+        if self.pending:
+            self.polling = self.widget.after(20, self.poll)
+
+    def scaled(self, source, size):
+        # Closest zoom/subsample ratio; subsampling goes as far as large downscales need
+        ratio = size / max(source.width(), source.height(), 1)
+        zoom, subsample = min(
+            (
+                (max(1, round(ratio * subsample)), subsample)
+                for subsample in range(1, max(8, math.ceil(2 / ratio)) + 1)
+            ),
+            key=lambda factors: abs(factors[0] / factors[1] - ratio),
+        )
+        # Subsampling first keeps the intermediate image small
+        image = source.subsample(subsample) if subsample > 1 else source
+        return image.zoom(zoom) if zoom > 1 else image
+
+    def add(self, key, image):
+        self.variants[key] = image
+        self.used_bytes += image.width() * image.height() * 4
+        while self.used_bytes > self.max_bytes and len(self.variants) > 1:
+            _, evicted = self.variants.popitem(last=False)
+            self.used_bytes -= evicted.width() * evicted.height() * 4
+
+
+class GridIndex:
+    """Bounding boxes of canvas items hashed into a uniform grid of cells."""
+
+    def __init__(self, cell=64):
+        self.cell = cell
+        self.cells = {}
+        self.boxes = {}
+
+    def cell_range(self, box):
+        x0, y0, x1, y1 = box
+        for cx in range(int(x0 // self.cell), int(x1 // self.cell) + 1):
+            for cy in range(int(y0 // self.cell), int(y1 // self.cell) + 1):
+                yield cx, cy
+
+    def insert(self, key, box):
+        self.boxes[key] = box
+        for cell in self.cell_range(box):
+            self.cells.setdefault(cell, set()).add(key)
+
+    def remove(self, key):
+        box = self.boxes.pop(key, None)
+        if box is None:
+            return
+        for cell in self.cell_range(box):
+            keys = self.cells.get(cell)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.cells[cell]
+
+    def query(self, box):
+        # Keys whose box intersects the given one
+        x0, y0, x1, y1 = box
+        found = set()
+        cx0, cx1 = int(x0 // self.cell), int(x1 // self.cell)
+        cy0, cy1 = int(y0 // self.cell), int(y1 // self.cell)
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            # A large box (e.g. zoomed far out): going through the occupied cells is cheaper
+            for (cx, cy), keys in self.cells.items():
+                if cx0 <= cx <= cx1 and cy0 <= cy <= cy1:
+                    found.update(keys)
+        else:
+            for cell in self.cell_range(box):
+                found.update(self.cells.get(cell, ()))
+        return [
+            key for key in found
+            if self.boxes[key][0] <= x1 and self.boxes[key][2] >= x0 and self.boxes[key][1] <= y1 and self.boxes[key][3] >= y0
+        ]
+
+
+def json_options(options):
+    return {
+        key: list(value) if isinstance(value, tuple) else value
+        if isinstance(value, (int, float, str)) else str(value)
+        for key, value in options.items()
+        if value is not None
+    }
+
+
+def point_in_polygon(x, y, points):
+    inside = False
+    for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+        if (y0 > y) != (y1 > y) and x < x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+            inside = not inside
+    return inside
+
+
+class Stroke:
+    """Pen stroke being drawn, with the cheap features used to recognize shapes."""
+
+    def __init__(self, x, y, item):
+        self.points = [(x, y)]
+        self.along = [0.0]
+        self.items = [item]
+        self.left = self.right = x
+        self.top = self.bottom = y
+
+    def add(self, x, y, item):
+        last_x, last_y = self.points[-1]
+        self.along.append(self.along[-1] + math.hypot(x - last_x, y - last_y))
+        self.points.append((x, y))
+        self.items.append(item)
+        self.left = min(self.left, x)
+        self.right = max(self.right, x)
+        self.top = min(self.top, y)
+        self.bottom = max(self.bottom, y)
+
+    def simplify(self, tolerance=0.5):
+        # Ramer-Douglas-Peucker: drops the points that move the polyline by less than the tolerance
+        points = self.points
+        if len(points) < 3:
+            return list(points)
+        keep = [False] * len(points)
+        keep[0] = keep[-1] = True
+        todo = [(0, len(points) - 1)]
+        while todo:
+            first, last = todo.pop()
+            (x0, y0), (x1, y1) = points[first], points[last]
+            chord = math.hypot(x1 - x0, y1 - y0)
+            farthest, distance = None, tolerance
+            for idx in range(first + 1, last):
+                x, y = points[idx]
+                if chord:
+                    gap = abs((x1 - x0) * (y0 - y) - (x0 - x) * (y1 - y0)) / chord
+                else:
+                    gap = math.hypot(x - x0, y - y0)
+                if gap > distance:
+                    farthest, distance = idx, gap
+            if farthest is not None:
+                keep[farthest] = True
+                todo.append((first, farthest))
+                todo.append((farthest, last))
+        return [point for point, kept in zip(points, keep) if kept]
+
+    def classify(self, min_size=30):
+        # Returns ("line" | "arrow", (x0, y0, x1, y1)), ("rectangle" | "oval", bbox) or None
+        length = self.along[-1]
+        if len(self.points) < 5 or max(self.right - self.left, self.bottom - self.top) < min_size:
+            return None
+        (x0, y0), (x1, y1) = self.points[0], self.points[-1]
+        chord = math.hypot(x1 - x0, y1 - y0)
+        if chord > 0.95 * length:
+            return "line", (x0, y0, x1, y1)
+        if chord < 0.2 * length:
+            return self.classify_closed()
+        return self.classify_arrow()
+
+    def classify_closed(self):
+        cx, cy = (self.left + self.right) / 2, (self.top + self.bottom) / 2
+        rx, ry = max((self.right - self.left) / 2, 1), max((self.bottom - self.top) / 2, 1)
+        ellipse_error = 0.0
+        rectangle_error = 0.0
+        for x, y in self.points:
+            dx, dy = (x - cx) / rx, (y - cy) / ry
+            ellipse_error += abs(math.hypot(dx, dy) - 1)
+            rectangle_error += min(abs(1 - abs(dx)), abs(1 - abs(dy)))
+        ellipse_error /= len(self.points)
+        rectangle_error /= len(self.points)
+        if min(ellipse_error, rectangle_error) > 0.12:
+            return None
+        kind = "rectangle" if rectangle_error < ellipse_error else "oval"
+        return kind, (self.left, self.top, self.right, self.bottom)
+
+    def classify_arrow(self):
+        # A straight shaft up to the point farthest from the start, then a short head around it
+        x0, y0 = self.points[0]
+        distances = [math.hypot(x - x0, y - y0) for x, y in self.points]
+        farthest = max(distances)
+        tip = next(idx for idx, distance in enumerate(distances) if distance >= 0.97 * farthest)
+        tx, ty = self.points[distances.index(farthest)]
+        shaft = math.hypot(tx - x0, ty - y0)
+        head = self.along[-1] - self.along[tip]
+        if self.along[tip] > 1.1 * shaft or not 0.1 * shaft < head < 0.8 * shaft:
+            return None
+        if any(math.hypot(x - tx, y - ty) > 0.4 * shaft for x, y in self.points[tip:]):
+            return None
+        return "arrow", (x0, y0, tx, ty)
+
+
+class Tool:
+    """Drawing tool: the canvas events go to the handlers of the active tool."""
+
+    # Key selecting the tool, and keys of its own (key -> queue command) while it is active
+    key = None
+    keys = {}
+
+    def start(self, p, event):
+        p.begin_stroke()
+
+    def motion(self, p, event):
+        pass
+
+    def release(self, p, event):
+        pass
+
+    def hover(self, p, event):
+        pass
+
+
+class PenTool(Tool):
+    key = "p"
+    recognizes = True
+
+    def paint_color(self, p):
+        return p.color
+
+    def start(self, p, event):
+        super().start(p, event)
+        item = p.create(
+            "line",
+            event.x,
+            event.y,
+            event.x,
+            event.y,
+            width=p.line_width,
+            fill=self.paint_color(p),
+            capstyle=tk.ROUND,
+            tags=p.item_tags("manual-start"),
+        )
+        p.stroke = Stroke(event.x, event.y, item)
+
+    def motion(self, p, event):
+        item = p.create(
+            "line",
+            p.start_x,
+            p.start_y,
+            event.x,
+            event.y,
+            width=p.line_width,
+            fill=self.paint_color(p),
+            capstyle=tk.ROUND,
+            tags=p.item_tags("manual"),
+        )
+        if p.stroke is not None:
+            p.stroke.add(event.x, event.y, item)
+        p.start_x = event.x
+        p.start_y = event.y
+
+    def release(self, p, event):
+        if p.stroke is None:
+            return
+        shape = p.recognize_stroke() if self.recognizes and p.recognize else None
+        if shape is None:
+            p.merge_stroke(self.paint_color(p))
+        p.stroke = None
+        p.end_ink_batch(outline=shape not in [None, "line"])
+
+    def hover(self, p, event):
+        if p.ghost:
+            p.c.delete(p.ghost)
+        width = p.line_width / 2
+        p.ghost = p.c.create_oval(
+            event.x - width, event.y - width, event.x + width, event.y + width, outline="black", width=1
+        )
+
+
+class EraserTool(PenTool):
+    key = None
+    recognizes = False
+
+    def paint_color(self, p):
+        return p.bg_color
+
+
+class ShapeTool(Tool):
+    """Rectangle or ellipse dragged from a corner; Shift and Alt change how the mouse shapes it."""
+
+    kind = None
+    # Radius of the centered shape drawn with Alt, from the mouse offset
+    radius = None
+
+    def box(self, p, event):
+        if p.shift_pressed:
+            return p.start_x, p.start_y, event.x, p.start_y - (p.start_x - event.x)
+        if p.alt_pressed:
+            radius = self.radius(p.start_x - event.x, p.start_y - event.y)
+            return p.start_x - radius, p.start_y - radius, p.start_x + radius, p.start_y + radius
+        return p.start_x, p.start_y, event.x, event.y
+
+    def motion(self, p, event):
+        if p.ghost:
+            p.c.delete(p.ghost)
+        create = p.c.create_rectangle if self.kind == "rectangle" else p.c.create_oval
+        p.ghost = create(*self.box(p, event), outline=p.color, fill=p.fill_color, width=p.line_width)
+
+    def release(self, p, event):
+        p.create(
+            self.kind, *self.box(p, event), outline=p.color, fill=p.fill_color, width=p.line_width, tags=p.item_tags()
+        )
+        p.end_ink_batch(outline=True)
+
+
+class RectangleTool(ShapeTool):
+    key = "r"
+    kind = "rectangle"
+    radius = staticmethod(min)
+
+
+class EllipseTool(ShapeTool):
+    key = "e"
+    kind = "oval"
+    radius = staticmethod(math.hypot)
+
+
+class ArrowTool(Tool):
+    key = "a"
+
+    def motion(self, p, event):
+        if p.ghost:
+            p.c.delete(p.ghost)
+        p.ghost = p.c.create_polygon(
+            *p.arrow_coords(p.start_x, p.start_y, event.x, event.y),
+            outline=p.color,
+            fill=p.fill_color,
+            width=p.line_width,
+        )
+
+    def release(self, p, event):
+        p.create(
+            "polygon",
+            *p.arrow_coords(p.start_x, p.start_y, event.x, event.y),
+            outline=p.color,
+            fill=p.fill_color,
+            width=p.line_width,
+            tags=p.item_tags(),
+        )
+        p.end_ink_batch(outline=True)
+
+
+class TextTool(Tool):
+    def start(self, p, event):
+        super().start(p, event)
+        p.create("text", event.x, event.y, text=p.text_input.get(), fill=p.color, font=p.font, tags=p.item_tags())
+
+    def release(self, p, event):
+        # A single click writes the text once, unless typing goes on
+        if not p.letter_capture:
+            the_queue.put("mode pen")
+
+    def hover(self, p, event):
+        if p.ghost:
+            p.c.delete(p.ghost)
+        p.ghost = p.c.create_text(event.x, event.y, text=p.text_input.get(), fill=p.color, font=p.font)
+
+
+class StampTool(Tool):
+    key = "i"
+    keys = {"i": "stamp next"}
+
+    def start(self, p, event):
+        super().start(p, event)
+        image = p.stamp_image()
+        if image is not None:
+            p.create("image", event.x, event.y, image=image, tags=p.item_tags("stamp"))
+
+    def hover(self, p, event):
+        if p.ghost:
+            p.c.delete(p.ghost)
+            p.ghost = None
+        image = p.stamp_image()
+        if image is not None:
+            p.ghost = p.c.create_image(event.x, event.y, image=image)
+
+
+class LaserTool(Tool):
+    key = "l"
+
+    def start(self, p, event):
+        # Points at things, nothing is drawn
+        pass
+
+    def motion(self, p, event):
+        p.move_laser(event)
+
+    def hover(self, p, event):
+        p.move_laser(event)
+
+
+class SelectTool(Tool):
+    def start(self, p, event):
+        p.select_start(event)
+
+    def motion(self, p, event):
+        p.select_motion(event)
+
+    def release(self, p, event):
+        p.select_release(event)
+
+
+TOOLS = {
+    "pen": PenTool,
+    "eraser": EraserTool,
+    "rectangle": RectangleTool,
+    "ellipse": EllipseTool,
+    "arrow": ArrowTool,
+    "text": TextTool,
+    "stamp": StampTool,
+    "laser": LaserTool,
+    "select": SelectTool,
+}
+
+
 class Painter(tk.Frame):
 
     WIN_TITLE = "DrawOnStream - Painter"
-
-    def __init__(self, root=None):
+    PAGE_SWITCH_BUDGET = 0.1
+    LASER_COLOR = "#ff0000"
+    LASER_POINTS = 32
+    LASER_TRAIL = 0.25
+    ZOOM_STEP = 1.1
+    ZOOM_RANGE = (0.05, 20.0)
+    QUEUE_POLL = 100
+    QUEUE_POLL_REMOTE = 10
+
+    def __init__(self, root=None, measure_startup=False):
         super().__init__(root)
         self.root = root
-        self.Display = Xlib.display.Display()
-        self.rootWnd = self.Display.create_resource_object("window",self.root.winfo_id())
+        self.measure_startup = measure_startup
         self.root.title(self.WIN_TITLE)
 
         # Some variables
-        self.items = []
         self.font = tkFont.Font(family="Helvetica", size=20)
         self.text_input = tk.StringVar(self.root)
         self.fill_color = None
@@ -287,21 +1143,24 @@ class Painter(tk.Frame):
 
         self.load_config()
 
-        if self.separate :
+        if self.separate == "process" :
+            self.start_commander_process()
+            self.root.wm_attributes("-type", "utility")
+            self.root.wm_attributes("-topmost", 1)
+
+        elif self.separate :
 
             self.toplevel = tk.Toplevel()
-            self.commander = Commander(self.toplevel)
+            self.commander = Commander(self.toplevel, deferred=True)
             self.menu_bar = self.commander.menu_bar
             self.status_bar = self.commander.status_bar
             self.toplevel.protocol("WM_DELETE_WINDOW", self.on_closing)
             self.root.wm_attributes("-type", "utility")
             self.root.wm_attributes("-topmost", 1)
 
-            self.follow()
-
         else :
         # The canvas
-            self.menu_bar = MenuBar(self.root)
+            self.menu_bar = MenuBar(self.root, deferred=True)
             self.menu_bar.pack(side=tk.TOP, fill=tk.X)
 
             self.status_bar = StatusBar(self.root)
@@ -312,6 +1171,33 @@ class Painter(tk.Frame):
 
         # Initialize some stuff
         self.setup()
+        self.update_panels()
+
+        # Do not block on wait_visibility: the rest happens once the canvas is mapped
+        self.c.bind("<Map>", self.on_first_map)
+
+        self.root.bind("<Configure>", self.on_configure)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        STARTUP["constructed"] = time.perf_counter()
+
+    def start_commander_process(self):
+        # The control panel gets its own Tk interpreter, so its dialogs cannot stall the canvas
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        commands_in, commands_out = context.Pipe(duplex=False)
+        status_in, status_out = context.Pipe(duplex=False)
+        self.commander_process = context.Process(target=run_commander, args=(commands_out, status_in), daemon=True)
+        self.commander_process.start()
+        # Only the child holds its ends, so its death shows up as EOF here
+        commands_out.close()
+        status_in.close()
+        outbox = queue.Queue()
+        threading.Thread(target=forward_commands, args=(commands_in,), daemon=True).start()
+        threading.Thread(target=forward_status, args=(outbox, status_out), daemon=True).start()
+        self.menu_bar = RemotePanel("menu", outbox)
+        self.status_bar = RemotePanel("status", outbox)
+
+    def update_panels(self):
         self.status_bar.update_status(
             width=self.line_width,
             color=self.color,
@@ -319,6 +1205,12 @@ class Painter(tk.Frame):
             mode=self.mode,
             alpha=self.alpha,
             fill=self.fill_color,
+            ink=self.ink,
+            recognize=self.recognize,
+            stamp=self.stamps[self.stamp] if self.stamps else None,
+            view=self.view,
+            layers=self.layers_status(),
+            page=(self.page + 1, len(self.pages)),
         )
         self.menu_bar.update_status(
             width=self.line_width,
@@ -328,13 +1220,57 @@ class Painter(tk.Frame):
             alpha=self.alpha,
             fill=self.fill_color,
             separate=self.separate,
+            ink=self.ink,
+            recognize=self.recognize,
         )
 
-        self.root.wait_visibility(self.root)
+    def commander_lost(self):
+        # The Commander process died: its panel comes back as a window of this process
+        print("the Commander process is gone, opening the panel here")
+        self.toplevel = tk.Toplevel()
+        self.commander = Commander(self.toplevel)
+        # The config keeps asking for a Commander process next time
+        self.commander.menu_bar.separate_button.grid_remove()
+        self.menu_bar = self.commander.menu_bar
+        self.status_bar = self.commander.status_bar
+        self.toplevel.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.update_panels()
+
+    def on_first_map(self, event):
+        self.c.unbind("<Map>")
+        STARTUP["first_paint"] = time.perf_counter()
         self.root.wm_attributes("-alpha", self.alpha / 100.0)
+        # The toolbar and the X11 window following are filled in after the canvas is usable
+        self.root.after_idle(self.finish_startup)
+
+    def finish_startup(self):
+        self.menu_bar.build()
+        # Following another window only happens with the command panel apart, as before
+        if self.separate and self.following is not None :
+            self.setup_following()
+            self.follow()
+        STARTUP["toolbar"] = time.perf_counter()
+        if self.measure_startup :
+            self.report_startup()
+
+    def setup_following(self) :
+        # X11 and wmctrl are only needed to stick to another window
+        import wmctrl
+        import Xlib.display
+        if self.configfollowing.startswith("*") :
+            self.wmctrl_get = wmctrl.Window.by_name_endswith
+        elif self.configfollowing.endswith("*") :
+            self.wmctrl_get = wmctrl.Window.by_name_startswith
+        else :
+            self.wmctrl_get = wmctrl.Window.by_name
+        self.Display = Xlib.display.Display()
+        self.rootWnd = self.Display.create_resource_object("window", self.root.winfo_id())
 
-        self.root.bind("<Configure>", self.on_configure)
-        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+    def report_startup(self):
+        start = STARTUP["start"]
+        for step in ["imports", "constructed", "first_paint", "toolbar"]:
+            print("{:>12}: {:8.1f} ms".format(step, (STARTUP[step] - start) * 1000))
+        self.root.destroy()
 
     def follow(self) :
         if self.following is not None :
@@ -390,9 +1326,19 @@ class Painter(tk.Frame):
             "alpha": self.alpha,
             "fill": self.fill_color,
             "geometry": self.root.geometry(),
-            "separate" : bool(self.menu_bar.separate_status.get()),
+            "separate" : "process" if self.separate == "process" else bool(self.menu_bar.separate_status.get()),
             "following" : self.configfollowing,
             "ratio" : self.ratio,
+            "ink": self.ink,
+            "ink_lifetime": self.ink_lifetime,
+            "ink_fade": self.ink_fade,
+            "layers": list(self.layers),
+            "layer": self.layer_name,
+            "session": self.session,
+            "recognize": self.recognize,
+            "stamps": self.stamps,
+            "stamp_cache_mb": self.stamp_cache_mb,
+            "tools": self.config.get("tools", DEFAULT["tools"]),
         }
         print(config)
         json.dump(config, open("config.json", "w"), indent=2)
@@ -409,27 +1355,41 @@ class Painter(tk.Frame):
         self.font.configure(size=(self.line_width * 5))
         self.color = config.get("color", DEFAULT["color"])
         self.bg_color = config.get("background", DEFAULT["background"])
-        self.mode = config.get("mode", DEFAULT["mode"])
         self.alpha = int(config.get("alpha", DEFAULT["alpha"]))
         self.fill_color = config.get("fill", DEFAULT["fill"])
         self.separate = config.get("separate", DEFAULT["separate"])
         self.configfollowing = config.get("following", DEFAULT["following"])
         if isinstance(self.configfollowing, str) :
             if self.configfollowing.startswith("*") :
-                self.wmctrl_get = wmctrl.Window.by_name_endswith
                 self.following = self.configfollowing[1:]
             elif self.configfollowing.endswith("*") :
-                self.wmctrl_get = wmctrl.Window.by_name_startswith
                 self.following = self.configfollowing[:-1]
             else :
-                self.wmctrl_get = wmctrl.Window.by_name
                 self.following = self.configfollowing
         else :
             self.following = None
         self.followingWnd = None
+        self.layers = {}
+        for idx, name in enumerate(config.get("layers", DEFAULT["layers"])):
+            self.layers[name] = {"tag": "layer{}".format(idx), "items": {}, "visible": True, "index": None}
+        self.select_layer(config.get("layer", DEFAULT["layer"]))
+        # Records of all the layers, looked up by canvas id without copying them
+        self.records = collections.ChainMap(*(layer["items"] for layer in self.layers.values()))
         self.ratio = config.get("ratio", DEFAULT["ratio"])
         if isinstance(self.ratio, str) :
             self.ratio = tuple(int(x) for x in self.ratio.split("x"))
+        self.session = config.get("session", DEFAULT["session"])
+        self.recognize = bool(config.get("recognize", DEFAULT["recognize"]))
+        self.stamps = list(config.get("stamps", DEFAULT["stamps"]))
+        self.stamp = 0
+        self.stamp_cache_mb = config.get("stamp_cache_mb", DEFAULT["stamp_cache_mb"])
+        self.ink = config.get("ink", DEFAULT["ink"])
+        self.ink_lifetime = float(config.get("ink_lifetime", DEFAULT["ink_lifetime"]))
+        self.ink_fade = float(config.get("ink_fade", DEFAULT["ink_fade"]))
+        self.load_tools()
+        self.build_keys()
+        if not self.select_tool(config.get("mode", DEFAULT["mode"])):
+            self.select_tool(DEFAULT["mode"])
 
     def setup(self):
         geometry = self.config.get("geometry", None)
@@ -438,9 +1398,42 @@ class Painter(tk.Frame):
         self.c.configure(bg=self.bg_color)
 
         self.text_input.set("")
+        self.history = []
+        self.history_start = time.monotonic()
+        self.log("background", self.bg_color)
         self.start_x = None
         self.start_y = None
         self.ghost = None
+        self.ink_tag = None
+        self.ink_count = 0
+        self.layer_anchor = None
+        self.stroke = None
+        # id(record of a recognized shape) -> (record, records of the stroke it replaced);
+        # records outlive page switches, canvas ids do not
+        self.raw_strokes = {}
+        self.stamp_cache = StampCache(self.c, self.stamp_cache_mb * 1024 * 1024)
+        # The stamps get decoded in the background before they are first used
+        for path in self.stamps:
+            self.stamp_cache.request(path, self.stamp_size())
+        # Records are in scene coordinates: canvas = (scene - origin) * zoom
+        self.view = (0.0, 0.0, 1.0)
+        self.pan_last = None
+        # Items out of the viewport are hidden and tagged "culled", their canvas coordinates going stale
+        self.onscreen = set()
+        self.cull_pending = None
+        self.selection = []
+        self.selection_box = None
+        self.select_drag = False
+        self.lasso = []
+        # The laser trail is a single canvas item that is never part of the drawing
+        self.laser_trail = RingBuffer(self.LASER_POINTS)
+        self.laser_item = None
+        self.laser_timer = None
+        self.expiry = ExpiryScheduler(self.c, self.expire_ink)
+        # Only the page on screen lives on the canvas, the others are kept as records
+        self.pages = [None]
+        self.page = 0
+        self.page_latency = 0.0
         self.c.bind("<Button-1>", self.draw_start)
         self.c.bind("<Shift-Button-1>", self.draw_start_with_shift)
         self.c.bind("<Alt-Button-1>", self.draw_start_with_alt)
@@ -449,6 +1442,15 @@ class Painter(tk.Frame):
         self.c.bind("<Button-3>", self.draw_line_start)
         self.c.bind("<B3-Motion>", self.draw_line_motion)
         self.c.bind("<ButtonRelease-3>", self.draw_line_release)
+        self.c.bind("<Control-Button-1>", self.pan_start)
+        self.c.bind("<Control-B1-Motion>", self.pan_motion)
+        self.c.bind("<Control-ButtonRelease-1>", self.pan_end)
+        self.c.bind("<Button-4>", lambda event: self.zoom_at(event.x, event.y, self.ZOOM_STEP))
+        self.c.bind("<Button-5>", lambda event: self.zoom_at(event.x, event.y, 1 / self.ZOOM_STEP))
+        self.c.bind(
+            "<MouseWheel>",
+            lambda event: self.zoom_at(event.x, event.y, self.ZOOM_STEP if event.delta > 0 else 1 / self.ZOOM_STEP),
+        )
         self.c.bind("<Motion>", self.motion)
         self.c.bind("<Leave>", self.reset)
         self.root.bind("<Key>", self.key_up)
@@ -457,107 +1459,563 @@ class Painter(tk.Frame):
 
     def check_queue(self):
         while not the_queue.empty():
-            message = the_queue.get(block=False).split(" ", 1)
-            # print('queue got', message)
-            # process message
-            if message[0] == "color":
-                self.color = message[1]
-                self.status_bar.update_status(color=self.color)
-                self.menu_bar.update_status(color=self.color)
-            elif message[0] == "background":
-                self.bg_color = message[1]
-                self.c.configure(bg=self.bg_color)
-                self.status_bar.update_status(bg_color=self.bg_color)
-                self.menu_bar.update_status(bg_color=self.bg_color)
-            elif message[0] == "wipe":
-                self.wipe_canvas()
-            elif message[0] == "undo":
-                self.undo()
-            elif message[0] == "mode":
-                self.mode = message[1]
+            message = the_queue.get(block=False)
+            try:
+                self.process_message(message.split(" ", 1))
+            except Exception:
+                # A bad command is dropped, the queue keeps going
+                traceback.print_exc()
+        # check again later, soon when commands come from the Commander process
+        self.root.after(self.QUEUE_POLL_REMOTE if self.separate == "process" else self.QUEUE_POLL, self.check_queue)
+
+    def process_message(self, message):
+        if message[0] == "color":
+            self.color = message[1]
+            if self.selection:
+                self.recolor_selection(self.color)
+            self.status_bar.update_status(color=self.color)
+            self.menu_bar.update_status(color=self.color)
+        elif message[0] == "background":
+            self.bg_color = message[1]
+            self.c.configure(bg=self.bg_color)
+            self.log("background", self.bg_color)
+            self.status_bar.update_status(bg_color=self.bg_color)
+            self.menu_bar.update_status(bg_color=self.bg_color)
+        elif message[0] == "wipe":
+            self.wipe_canvas()
+        elif message[0] == "undo":
+            self.undo()
+        elif message[0] == "mode":
+            if self.select_tool(message[1]):
+                if self.mode != "select":
+                    self.clear_selection()
                 self.reset(None)
                 self.status_bar.update_status(mode=self.mode)
                 self.menu_bar.update_status(mode=self.mode)
-            elif message[0] == "width":
-                width = int(message[1])
-                self.line_width = width
-                self.font.configure(size=(width * 5))
-                self.status_bar.update_status(width=self.line_width)
-                self.menu_bar.update_status(width=self.line_width)
-            elif message[0] == "alpha":
-                self.alpha = int(message[1])
-                self.root.wm_attributes("-alpha", self.alpha / 100.0)
-                self.status_bar.update_status(alpha=self.alpha)
-                self.menu_bar.update_status(alpha=self.alpha)
-            elif message[0] == "text":
-                self.text_input.set(message[1])
-                self.status_bar.update_status(text=message[1])
-                self.menu_bar.update_status(text=message[1])
-            elif message[0] == "fill":
-                self.fill_color = self.color if int(message[1]) else None
-                self.status_bar.update_status(fill=self.fill_color)
-                self.menu_bar.update_status(fill=self.fill_color)
-        # check again later
-        self.root.after(100, self.check_queue)
+        elif message[0] == "width":
+            width = int(message[1])
+            self.line_width = width
+            self.font.configure(size=(width * 5))
+            self.status_bar.update_status(width=self.line_width)
+            self.menu_bar.update_status(width=self.line_width)
+        elif message[0] == "alpha":
+            self.alpha = int(message[1])
+            self.root.wm_attributes("-alpha", self.alpha / 100.0)
+            self.status_bar.update_status(alpha=self.alpha)
+            self.menu_bar.update_status(alpha=self.alpha)
+        elif message[0] == "text":
+            self.text_input.set(message[1])
+            self.status_bar.update_status(text=message[1])
+            self.menu_bar.update_status(text=message[1])
+        elif message[0] == "fill":
+            self.fill_color = self.color if int(message[1]) else None
+            self.status_bar.update_status(fill=self.fill_color)
+            self.menu_bar.update_status(fill=self.fill_color)
+        elif message[0] == "layer":
+            self.clear_selection()
+            self.select_layer(message[1])
+            self.status_bar.update_status(layers=self.layers_status())
+        elif message[0] in ["clear", "hide", "show", "toggle"]:
+            name = message[1] if len(message) > 1 else self.layer_name
+            if name in self.layers:
+                getattr(self, "{}_layer".format(message[0]))(name)
+                self.status_bar.update_status(layers=self.layers_status())
+        elif message[0] == "page":
+            argument = message[1] if len(message) > 1 else ""
+            if argument == "next":
+                if self.page == len(self.pages) - 1:
+                    self.pages.append(())
+                self.goto_page(self.page + 1)
+            elif argument == "prev":
+                self.goto_page(self.page - 1)
+            elif argument.isdigit():
+                self.goto_page(int(argument) - 1)
+            self.status_bar.update_status(page=(self.page + 1, len(self.pages)))
+        elif message[0] == "recognize":
+            self.recognize = bool(int(message[1]))
+            self.status_bar.update_status(recognize=self.recognize)
+            self.menu_bar.update_status(recognize=self.recognize)
+        elif message[0] == "view":
+            self.set_view(0.0, 0.0, 1.0)
+        elif message[0] == "scale":
+            self.scale_selection(float(message[1]))
+        elif message[0] == "stamp":
+            if message[1] == "next":
+                self.stamp = (self.stamp + 1) % max(len(self.stamps), 1)
+            elif message[1].isdigit():
+                self.stamp = max(0, min(int(message[1]) - 1, len(self.stamps) - 1))
+            else:
+                if message[1] not in self.stamps:
+                    self.stamps.append(message[1])
+                self.stamp = self.stamps.index(message[1])
+            self.status_bar.update_status(stamp=self.stamps[self.stamp] if self.stamps else None)
+        elif message[0] == "save":
+            self.save_session(message[1] if len(message) > 1 else self.session)
+        elif message[0] == "commander":
+            self.commander_lost()
+        elif message[0] == "quit":
+            # After the queue loop is done: it re-arms its timer on the window
+            self.root.after_idle(self.on_closing)
+        elif message[0] == "ink":
+            self.ink = message[1]
+            self.status_bar.update_status(ink=self.ink)
+            self.menu_bar.update_status(ink=self.ink)
 
     def key_up(self, event):
         ctrl = (event.state & 0x4) != 0
-        # print(event, '---', self.letter_capture)
-        if event.keysym == "Escape":
-            self.letter_capture = False
-            the_queue.put("mode pen")
-            return
-        if self.letter_capture:
+        # Printable keys go by their character, the others (and Ctrl letters) by their name
+        key = event.char if event.char and event.char.isprintable() else event.keysym
+        if ctrl:
+            keys = self.ctrl_keys
+        elif self.letter_capture:
+            # Typed letters are text, only Escape and the paging keys still work
             if event.char and event.char.isprintable():
                 the_queue.put("text {}".format(event.char))
-        if ctrl:
-            if event.keysym == "l":
-                self.letter_capture = True
-                the_queue.put("mode text")
-            if event.keysym == "z":
-                the_queue.put("undo")
-            if event.keysym == "w":
-                the_queue.put("wipe")
-            if event.char == "+":
-                value = int(min(100, self.alpha + 5))
-                the_queue.put("alpha {}".format(value))
-            if event.char == "-":
-                value = int(max(1, self.alpha - 5))
-                the_queue.put("alpha {}".format(value))
-            if event.keysym == "r":
-                the_queue.put("alpha {}".format(DEFAULT["alpha"]))
+            keys = self.common_keys
         else:
-            if event.char == "r":
-                the_queue.put("mode rectangle")
-            if event.char == "e":
-                the_queue.put("mode ellipse")
-            if event.char == "a":
-                the_queue.put("mode arrow")
-            if event.char == "p":
-                the_queue.put("mode pen")
-            if event.char == "f":
-                the_queue.put("fill {}".format(0 if self.fill_color else 1))
-            if event.char == "+":
-                value = int(min(10, self.line_width + 1))
-                the_queue.put("width {}".format(value))
-            if event.char == "-":
-                value = int(max(1, self.line_width - 1))
-                the_queue.put("width {}".format(value))
+            keys = self.keys
+        action = keys.get(key)
+        if action is not None:
+            action()
+
+    def build_keys(self):
+        def put(command):
+            return lambda: the_queue.put(command)
+
+        common = self.common_keys = {"Escape": self.escape, "Next": put("page next"), "Prior": put("page prev")}
+        self.ctrl_keys = dict(
+            common,
+            l=self.capture_letters,
+            z=put("undo"),
+            w=put("wipe"),
+            s=put("save"),
+            r=lambda: the_queue.put("alpha {}".format(DEFAULT["alpha"])),
+        )
+        self.ctrl_keys["+"] = lambda: the_queue.put("alpha {}".format(int(min(100, self.alpha + 5))))
+        self.ctrl_keys["-"] = lambda: the_queue.put("alpha {}".format(int(max(1, self.alpha - 5))))
+        for digit in "123456789":
+            self.ctrl_keys[digit] = put("page {}".format(digit))
+        self.plain_keys = dict(
+            common,
+            f=lambda: the_queue.put("fill {}".format(0 if self.fill_color else 1)),
+            c=put("clear"),
+            h=put("toggle"),
+            s=lambda: the_queue.put("recognize {}".format(0 if self.recognize else 1)),
+            d=lambda: the_queue.put("ink {}".format("permanent" if self.ink == "disappearing" else "disappearing")),
+        )
+        self.plain_keys["0"] = put("view reset")
+        self.plain_keys["+"] = lambda: self.plus_minus(1)
+        self.plain_keys["-"] = lambda: self.plus_minus(-1)
+        for idx, name in enumerate(list(self.layers)[:9]):
+            self.plain_keys[str(idx + 1)] = put("layer {}".format(name))
+        for key, name in self.tool_keys.items():
+            self.plain_keys[key] = put("mode {}".format(name))
+        self.keys = self.plain_keys
+
+    def escape(self):
+        self.letter_capture = False
+        the_queue.put("mode pen")
+
+    def capture_letters(self):
+        self.letter_capture = True
+        the_queue.put("mode text")
+
+    def plus_minus(self, sign):
+        if self.selection:
+            the_queue.put("scale {}".format(1.25 if sign > 0 else 0.8))
+        else:
+            the_queue.put("width {}".format(int(min(10, max(1, self.line_width + sign)))))
+
+    def load_tools(self):
+        # Plugin tools are "module:Class" names in the config, imported when first selected
+        self.tools = dict(TOOLS)
+        self.tool_keys = {tool.key: name for name, tool in TOOLS.items() if tool.key}
+        for name, spec in self.config.get("tools", DEFAULT["tools"]).items():
+            if isinstance(spec, dict):
+                if spec.get("key"):
+                    self.tool_keys[spec["key"]] = name
+                spec = spec["class"]
+            self.tools[name] = spec
+
+    def get_tool(self, name):
+        tool = self.tools.get(name)
+        if isinstance(tool, str):
+            import importlib
+
+            module, _, attr = tool.partition(":")
+            try:
+                tool = getattr(importlib.import_module(module), attr)
+            except (ImportError, AttributeError) as error:
+                print("cannot load tool {}: {}".format(name, error))
+                return None
+            self.tools[name] = tool
+        if isinstance(tool, type):
+            tool = self.tools[name] = tool()
+        return tool
+
+    def select_tool(self, name):
+        tool = self.get_tool(name)
+        if tool is None:
+            return False
+        self.mode = name
+        self.tool = tool
+        # The active tool's own keys come first
+        self.keys = dict(self.plain_keys)
+        for key, command in tool.keys.items():
+            self.keys[key] = partial(the_queue.put, command)
+        return True
 
     def undo(self):
+        self.clear_selection()
         if len(self.items):
-            item = self.items[-1]
+            item, record = self.items.popitem()
+            self.unindex(item)
+            removed = [record]
             if "manual" in self.c.gettags(item) :
                 while "manual-start" not in self.c.gettags(item) :
                     self.c.delete(item)
-                    self.items.pop()
-                    item = self.items[-1]
+                    item, record = self.items.popitem()
+                    self.unindex(item)
+                    removed.append(record)
             self.c.delete(item)
-            self.items.pop()
+            self.log("delete", removed)
+            if id(record) in self.raw_strokes:
+                # Undoing a recognized shape brings back the stroke it replaced
+                self.find_layer_anchor()
+                for kind, coords, options in self.raw_strokes.pop(id(record))[1]:
+                    self.create(kind, *self.to_canvas(coords), **self.canvas_options(options))
 
     def wipe_canvas(self):
-        self.items.clear()
+        self.log("wipe")
+        self.drop_items()
+        self.raw_strokes.clear()
+
+    def drop_items(self):
+        self.clear_selection()
+        self.onscreen.clear()
+        for layer in self.layers.values():
+            layer["items"].clear()
+            layer["index"] = None
         self.c.delete("all")
+        self.expiry.clear()
+        self.layer_anchor = None
+        self.laser_item = None
+
+    def goto_page(self, index):
+        if index == self.page or not 0 <= index < len(self.pages):
+            return
+        start = time.perf_counter()
+        self.reset(None)
+        self.pages[self.page] = self.save_page()
+        # Disappearing ink is left behind, and so is what undo knew about it
+        kept = set(id(record) for record in self.pages[self.page])
+        self.forget_raw_strokes(record for record in self.records.values() if id(record) not in kept)
+        self.drop_items()
+        self.load_page(self.pages[index])
+        self.pages[index] = None
+        self.page = index
+        self.log("page", index)
+        self.page_latency = time.perf_counter() - start
+
+    def save_page(self):
+        records = {}
+        for layer in self.layers.values():
+            records.update(layer["items"])
+        # Stacking order is kept; disappearing ink is not worth bringing back
+        return tuple(
+            records[item]
+            for item in self.c.find_all()
+            if item in records and not any(tag.startswith("ink") for tag in records[item][2].get("tags", ()))
+        )
+
+    def load_page(self, page):
+        if not page:
+            return
+        # A single Tcl evaluation creates the whole page
+        body = ["set ids {}"]
+        for kind, coords, options in page:
+            body.append("lappend ids [{}]".format(
+                tcl_create(self.c._w, kind, self.to_canvas(coords), self.canvas_options(options))))
+        body.append("return $ids")
+        ids = self.c.tk.splitlist(self.c.tk.call("apply", ("", "\n".join(body))))
+        tags = {layer["tag"]: layer for layer in self.layers.values()}
+        for item, record in zip(ids, page):
+            for tag in record[2].get("tags", ()):
+                if tag in tags:
+                    tags[tag]["items"][int(item)] = record
+                    break
+        self.onscreen.update(int(item) for item in ids)
+        for layer in self.layers.values():
+            if not layer["visible"]:
+                self.c.itemconfigure(layer["tag"], state=tk.HIDDEN)
+        if self.view != (0.0, 0.0, 1.0):
+            self.cull()
+
+    def forget_raw_strokes(self, records):
+        for record in list(records):
+            self.raw_strokes.pop(id(record), None)
+
+    def select_layer(self, name):
+        if name not in self.layers:
+            name = next(iter(self.layers))
+        self.layer_name = name
+        self.layer = self.layers[name]
+        # Undo works on the active layer only
+        self.items = self.layer["items"]
+
+    def layers_status(self):
+        return [(name, name == self.layer_name, layer["visible"]) for name, layer in self.layers.items()]
+
+    def clear_layer(self, name):
+        self.log("clear", self.layers[name]["tag"])
+        self.clear_selection()
+        self.forget_raw_strokes(self.layers[name]["items"].values())
+        self.layers[name]["items"].clear()
+        self.layers[name]["index"] = None
+        self.c.delete(self.layers[name]["tag"])
+        self.layer_anchor = None
+
+    def hide_layer(self, name):
+        self.layers[name]["visible"] = False
+        self.log("hide", self.layers[name]["tag"])
+        self.c.itemconfigure(self.layers[name]["tag"], state=tk.HIDDEN)
+
+    def show_layer(self, name):
+        self.layers[name]["visible"] = True
+        self.log("show", self.layers[name]["tag"])
+        self.c.itemconfigure("{}&&!culled".format(self.layers[name]["tag"]), state=tk.NORMAL)
+
+    def toggle_layer(self, name):
+        if self.layers[name]["visible"]:
+            self.hide_layer(name)
+        else:
+            self.show_layer(name)
+
+    def item_tags(self, *tags):
+        tags = tags + (self.layer["tag"],)
+        if self.ink_tag is not None:
+            return tags + (self.ink_tag,)
+        return tags
+
+    def create(self, kind, *coords, **options):
+        item = getattr(self.c, "create_{}".format(kind))(*coords, **options)
+        if self.layer_anchor is not None:
+            self.c.lower(item, self.layer_anchor)
+        # Keep what is needed to draw the item again, e.g. when its page comes back.
+        # For stamps, the record also keeps the Tk image alive as long as the item.
+        record = (kind, self.to_world(coords), self.world_options(options))
+        self.items[item] = record
+        self.onscreen.add(item)
+        if self.layer["index"] is not None:
+            self.layer["index"].insert(item, self.item_bbox(item, record))
+        self.log("add", record)
+        return item
+
+    def item_bbox(self, item, record):
+        kind, coords, options = record
+        if kind in ["text", "image"]:
+            # Hidden items have no bounding box on the canvas
+            bbox = self.c.bbox(item)
+            return self.to_world(bbox) if bbox else (coords[0], coords[1], coords[0], coords[1])
+        pad = float(options.get("width", 1)) / 2
+        xs, ys = coords[0::2], coords[1::2]
+        return (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad)
+
+    def layer_index(self, layer=None):
+        # Built on first use, then kept up to date by create() and the selection tools
+        layer = layer or self.layer
+        if layer["index"] is None:
+            index = GridIndex()
+            for item, record in layer["items"].items():
+                index.insert(item, self.item_bbox(item, record))
+            layer["index"] = index
+        return layer["index"]
+
+    def unindex(self, item, layer=None):
+        # Deleted items leave the index, which would otherwise grow with everything ever drawn
+        layer = layer or self.layer
+        if layer["index"] is not None:
+            layer["index"].remove(item)
+
+    def to_canvas(self, coords):
+        ox, oy, zoom = self.view
+        if (ox, oy, zoom) == (0.0, 0.0, 1.0):
+            return tuple(coords)
+        return tuple((coord - (oy if idx % 2 else ox)) * zoom for idx, coord in enumerate(coords))
+
+    def to_world(self, coords):
+        ox, oy, zoom = self.view
+        if (ox, oy, zoom) == (0.0, 0.0, 1.0):
+            return tuple(coords)
+        return tuple(coord / zoom + (oy if idx % 2 else ox) for idx, coord in enumerate(coords))
+
+    def world_options(self, options):
+        if self.view[2] == 1.0 or "width" not in options:
+            return options
+        return dict(options, width=float(options["width"]) / self.view[2])
+
+    def canvas_options(self, options):
+        if self.view[2] == 1.0 or "width" not in options:
+            return options
+        return dict(options, width=float(options["width"]) * self.view[2])
+
+    def pan_start(self, event):
+        self.pan_last = (event.x, event.y)
+
+    def pan_motion(self, event):
+        ox, oy, zoom = self.view
+        last_x, last_y = self.pan_last
+        self.pan_last = (event.x, event.y)
+        self.set_view(ox - (event.x - last_x) / zoom, oy - (event.y - last_y) / zoom, zoom)
+
+    def pan_end(self, event):
+        self.pan_last = None
+
+    def zoom_at(self, x, y, factor):
+        ox, oy, zoom = self.view
+        new_zoom = min(max(zoom * factor, self.ZOOM_RANGE[0]), self.ZOOM_RANGE[1])
+        # The scene point under the mouse stays put
+        self.set_view(x / zoom + ox - x / new_zoom, y / zoom + oy - y / new_zoom, new_zoom)
+
+    def set_view(self, ox, oy, zoom):
+        old_ox, old_oy, old_zoom = self.view
+        self.view = (ox, oy, zoom)
+        # Only the items on screen follow the view, the culled ones are placed again when they come back
+        ratio = zoom / old_zoom
+        if ratio != 1:
+            self.c.scale("!culled", 0, 0, ratio, ratio)
+        dx, dy = (old_ox - ox) * zoom, (old_oy - oy) * zoom
+        if dx or dy:
+            self.c.move("!culled", dx, dy)
+        if ratio != 1:
+            self.set_widths(self.onscreen)
+        if self.selection:
+            self.show_selection_box()
+        if self.cull_pending is None:
+            self.cull_pending = self.root.after_idle(self.cull)
+        self.status_bar.update_status(view=self.view)
+
+    def set_widths(self, items):
+        widths = []
+        for item in items:
+            record = self.records.get(item)
+            if record is not None and record[0] not in ["text", "image"] and "width" in record[2]:
+                widths.extend((item, float(record[2]["width"]) * self.view[2]))
+        self.c.tk.call("apply", ("w widths", "foreach {i width} $widths {$w itemconfigure $i -width $width}"), self.c._w, widths)
+
+    def cull(self):
+        self.cull_pending = None
+        width, height = self.c.winfo_width(), self.c.winfo_height()
+        x0, y0, x1, y1 = self.to_world((-width * 0.1, -height * 0.1, width * 1.1, height * 1.1))
+        records = self.records
+        visible = set()
+        for layer in self.layers.values():
+            visible.update(item for item in self.layer_index(layer).query((x0, y0, x1, y1)) if item in layer["items"])
+        leaving = [item for item in self.onscreen if item not in visible and item in records]
+        entering = []
+        for item in visible:
+            if item not in self.onscreen:
+                kind, coords, options = records[item]
+                entering.append(item)
+                entering.append(list(self.to_canvas(coords)))
+                entering.append(
+                    float(options["width"]) * self.view[2] if kind not in ["text", "image"] and "width" in options else ""
+                )
+        hidden = [self.layers[name]["tag"] for name, layer in self.layers.items() if not layer["visible"]]
+        self.c.tk.call(
+            "apply",
+            (
+                "w leaving entering hidden",
+                "foreach i $leaving {$w addtag culled withtag $i; $w itemconfigure $i -state hidden}\n"
+                "foreach {i coords width} $entering {\n"
+                "    $w coords $i $coords\n"
+                "    if {$width ne {}} {$w itemconfigure $i -width $width}\n"
+                "    $w dtag $i culled\n"
+                "    set state normal\n"
+                "    foreach tag $hidden {if {$tag in [$w gettags $i]} {set state hidden}}\n"
+                "    $w itemconfigure $i -state $state\n"
+                "}",
+            ),
+            self.c._w,
+            leaving,
+            entering,
+            hidden,
+        )
+        self.onscreen = visible
+
+    def log(self, *event):
+        # Timestamped drawing history, replayed by the timelapse export
+        self.history.append((time.monotonic() - self.history_start,) + event)
+
+    def save_session(self, path):
+        numbers = {}
+        events = []
+        for event in self.history:
+            if event[1] == "add":
+                kind, coords, options = event[2]
+                numbers[id(event[2])] = len(numbers)
+                events.append([event[0], "add", kind, list(coords), json_options(options)])
+            elif event[1] == "delete":
+                events.append([event[0], "delete", [numbers[id(record)] for record in event[2]]])
+            elif event[1] == "update":
+                changes = []
+                for old, new in event[2]:
+                    numbers[id(new)] = numbers[id(old)]
+                    changes.append([numbers[id(new)], new[0], list(new[1]), json_options(new[2])])
+                events.append([event[0], "update", changes])
+            else:
+                events.append(list(event))
+        session = {
+            "size": [self.c.winfo_width(), self.c.winfo_height()],
+            "events": events,
+        }
+        json.dump(session, open(path, "w"))
+
+    def begin_stroke(self):
+        if not self.layer["visible"]:
+            self.show_layer(self.layer_name)
+            self.status_bar.update_status(layers=self.layers_status())
+        self.find_layer_anchor()
+        self.start_ink_batch()
+
+    def find_layer_anchor(self):
+        # New items go below the lowest item of the layers above the active one
+        above = list(self.layers)
+        above = above[above.index(self.layer_name) + 1:]
+        self.layer_anchor = None
+        if above:
+            found = self.c.find_withtag("||".join(self.layers[name]["tag"] for name in above))
+            if found:
+                self.layer_anchor = found[0]
+
+    def start_ink_batch(self):
+        # Everything drawn until the button is released expires together
+        if self.ink == "disappearing":
+            self.ink_count += 1
+            self.ink_tag = "ink{}".format(self.ink_count)
+        else:
+            self.ink_tag = None
+
+    def end_ink_batch(self, outline=False):
+        if self.ink_tag is not None:
+            self.expiry.schedule(self.ink_tag, self.ink_lifetime, self.ink_fade, outline)
+            self.ink_tag = None
+
+    def expire_ink(self, tags):
+        expression = "||".join(tags)
+        expired = set(self.c.find_withtag(expression))
+        self.c.delete(expression)
+        if self.layer_anchor in expired:
+            self.layer_anchor = None
+        removed = []
+        for layer in self.layers.values():
+            for item in expired:
+                if item in layer["items"]:
+                    removed.append(layer["items"].pop(item))
+                    self.unindex(item, layer)
+        self.forget_raw_strokes(removed)
+        if removed:
+            self.log("delete", removed)
 
     def reset(self, event):
         if self.ghost:
@@ -567,21 +2025,243 @@ class Painter(tk.Frame):
         self.start_y = None
         self.shift_pressed = False
         self.alt_pressed = False
+        if self.mode != "laser" or event is not None:
+            self.laser_trail.clear()
+            self.update_laser()
+
+    def move_laser(self, event):
+        self.laser_trail.push(event.x, event.y, time.monotonic())
+        self.update_laser()
+
+    def update_laser(self):
+        self.laser_trail.drop_older(time.monotonic() - self.LASER_TRAIL)
+        coords = self.laser_trail.coords()
+        if not coords:
+            if self.laser_item is not None:
+                self.c.itemconfigure(self.laser_item, state=tk.HIDDEN)
+            if self.laser_timer is not None:
+                self.root.after_cancel(self.laser_timer)
+                self.laser_timer = None
+            return
+        if len(coords) == 2:
+            coords = coords * 2
+        if self.laser_item is None:
+            self.laser_item = self.c.create_line(
+                *coords, fill=self.LASER_COLOR, width=self.line_width, capstyle=tk.ROUND, joinstyle=tk.ROUND
+            )
+        else:
+            self.c.coords(self.laser_item, *coords)
+            self.c.itemconfigure(self.laser_item, state=tk.NORMAL, width=self.line_width)
+            self.c.tag_raise(self.laser_item)
+        # The tail keeps shrinking while the pointer rests
+        if self.laser_timer is None:
+            self.laser_timer = self.root.after(30, self.tick_laser)
+
+    def tick_laser(self):
+        self.laser_timer = None
+        self.update_laser()
+
+    def stamp_size(self):
+        return self.line_width * 16
+
+    def stamp_image(self):
+        if not self.stamps:
+            return None
+        return self.stamp_cache.get(self.stamps[self.stamp], self.stamp_size())
 
     def motion(self, event):
-        if self.mode in ["pen", "eraser"]:
-            if self.ghost:
-                self.c.delete(self.ghost)
-            width = self.line_width / 2
-            self.ghost = self.c.create_oval(
-                event.x - width, event.y - width, event.x + width, event.y + width, outline="black", width=1
-            )
-        if self.mode == "text":
-            if self.ghost:
-                self.c.delete(self.ghost)
-            self.ghost = self.c.create_text(
-                event.x, event.y, text=self.text_input.get(), fill=self.color, font=self.font
-            )
+        self.tool.hover(self, event)
+
+    def select_start(self, event):
+        bbox = self.c.bbox("selected") if self.selection else None
+        if bbox and bbox[0] <= event.x <= bbox[2] and bbox[1] <= event.y <= bbox[3]:
+            self.select_drag = True
+        else:
+            self.select_drag = False
+            self.lasso = [(event.x, event.y)]
+
+    def select_motion(self, event):
+        if self.select_drag:
+            # The canvas moves the whole selection, the records follow on release
+            self.c.move("selected", event.x - self.start_x, event.y - self.start_y)
+            self.c.move(self.selection_box, event.x - self.start_x, event.y - self.start_y)
+            self.start_x = event.x
+            self.start_y = event.y
+            return
+        self.lasso.append((event.x, event.y))
+        if self.ghost:
+            self.c.delete(self.ghost)
+        if self.shift_pressed:
+            self.ghost = self.c.create_line(*[coord for point in self.lasso for coord in point], dash=(4, 4))
+        else:
+            x0, y0 = self.lasso[0]
+            self.ghost = self.c.create_rectangle(x0, y0, event.x, event.y, dash=(4, 4))
+
+    def select_release(self, event):
+        if self.select_drag:
+            self.select_drag = False
+            x0, y0 = self.c.coords(self.selection_box)[:2]
+            x1, y1 = self.selection_origin
+            if (x0, y0) != (x1, y1):
+                self.transform_selection(lambda x, y: (x + x0 - x1, y + y0 - y1))
+            return
+        x0, y0 = self.lasso[0]
+        if self.shift_pressed and len(self.lasso) > 2:
+            xs, ys = [x for x, y in self.lasso], [y for x, y in self.lasso]
+            box = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            box = (min(x0, event.x), min(y0, event.y), max(x0, event.x), max(y0, event.y))
+        # The index holds scene coordinates
+        box = self.to_world(box)
+        lasso = [self.to_world(point) for point in self.lasso]
+        index = self.layer_index()
+        picked = []
+        # Only live items of the layer can be picked
+        for item in index.query(box):
+            if item not in self.items:
+                continue
+            x_min, y_min, x_max, y_max = index.boxes[item]
+            if self.shift_pressed and len(self.lasso) > 2:
+                if point_in_polygon((x_min + x_max) / 2, (y_min + y_max) / 2, lasso):
+                    picked.append(item)
+            elif box[0] <= x_min and box[1] <= y_min and x_max <= box[2] and y_max <= box[3]:
+                picked.append(item)
+        self.select_items(picked)
+
+    def select_items(self, items):
+        self.clear_selection()
+        if not items:
+            return
+        self.selection = items
+        fill = []
+        outline = []
+        for item in items:
+            kind, coords, options = self.items[item]
+            if kind in ["line", "text"] or options.get("fill"):
+                fill.append(item)
+            if kind in ["rectangle", "oval", "polygon"]:
+                outline.append(item)
+        # A single Tcl evaluation tags the whole selection
+        self.c.tk.call(
+            "apply",
+            (
+                "w all fill outline",
+                "foreach i $all {$w addtag selected withtag $i}\n"
+                "foreach i $fill {$w addtag selected-fill withtag $i}\n"
+                "foreach i $outline {$w addtag selected-outline withtag $i}",
+            ),
+            self.c._w,
+            items,
+            fill,
+            outline,
+        )
+        self.show_selection_box()
+
+    def show_selection_box(self):
+        if self.selection_box is not None:
+            self.c.delete(self.selection_box)
+        bbox = self.c.bbox("selected")
+        if not bbox:
+            self.selection_box = None
+            self.clear_selection()
+            return
+        self.selection_box = self.c.create_rectangle(*bbox, dash=(4, 4), outline="black")
+        self.selection_origin = tuple(self.c.coords(self.selection_box)[:2])
+
+    def clear_selection(self):
+        if not self.selection:
+            return
+        self.selection = []
+        for tag in ["selected", "selected-fill", "selected-outline"]:
+            self.c.dtag(tag, tag)
+        if self.selection_box is not None:
+            self.c.delete(self.selection_box)
+            self.selection_box = None
+
+    def transform_selection(self, transform=None, color=None):
+        # Bring the records and the index in line with what the canvas did to the selection
+        index = self.layer_index()
+        if transform is not None and self.view != (0.0, 0.0, 1.0):
+            # The transform works on canvas coordinates
+            on_canvas = transform
+            transform = lambda x, y: self.to_world(on_canvas(*self.to_canvas((x, y))))
+        changes = []
+        for item in self.selection:
+            old = self.items.get(item)
+            if old is None:
+                continue
+            kind, coords, options = old
+            if transform is not None:
+                points = [transform(coords[idx], coords[idx + 1]) for idx in range(0, len(coords) - 1, 2)]
+                coords = tuple(coord for point in points for coord in point)
+            if color is not None:
+                options = dict(options)
+                if kind in ["rectangle", "oval", "polygon"]:
+                    options["outline"] = color
+                if kind in ["line", "text"] or options.get("fill"):
+                    options["fill"] = color
+            new = (kind, coords, options)
+            self.items[item] = new
+            if id(old) in self.raw_strokes:
+                self.raw_strokes[id(new)] = (new, self.raw_strokes.pop(id(old))[1])
+            index.remove(item)
+            index.insert(item, self.item_bbox(item, new))
+            changes.append((old, new))
+        self.log("update", changes)
+        self.show_selection_box()
+
+    def scale_selection(self, factor):
+        bbox = self.c.bbox("selected") if self.selection else None
+        if not bbox:
+            return
+        x0, y0, x1, y1 = bbox
+        cx, cy = (x0 + x1) / 2, (y0 + y1) / 2
+        self.c.scale("selected", cx, cy, factor, factor)
+        self.transform_selection(lambda x, y: (cx + (x - cx) * factor, cy + (y - cy) * factor))
+
+    def recolor_selection(self, color):
+        self.c.itemconfigure("selected-fill", fill=color)
+        self.c.itemconfigure("selected-outline", outline=color)
+        self.transform_selection(color=color)
+
+    def arrow_coords(self, start_x, start_y, end_x, end_y):
+        tip1 = (
+            end_x
+            + (
+                0.2
+                * (
+                    ((start_x - end_x) * math.cos(math.pi / 6))
+                    + ((start_y - end_y) * math.sin(math.pi / 6))
+                )
+            ),
+            end_y
+            + (
+                0.2
+                * (
+                    ((start_y - end_y) * math.cos(math.pi / 6))
+                    - ((start_x - end_x) * math.sin(math.pi / 6))
+                )
+            ),
+        )
+        tip2 = (
+            end_x
+            + (
+                0.2
+                * (
+                    ((start_x - end_x) * math.cos(math.pi / 6))
+                    - ((start_y - end_y) * math.sin(math.pi / 6))
+                )
+            ),
+            end_y
+            + (
+                0.2
+                * (
+                    ((start_y - end_y) * math.cos(math.pi / 6))
+                    + ((start_x - end_x) * math.sin(math.pi / 6))
+                )
+            ),
+        )
+        return (start_x, start_y, end_x, end_y, tip1[0], tip1[1], end_x, end_y, tip2[0], tip2[1], end_x, end_y)
 
     def draw_start_with_shift(self, event):
         self.shift_pressed = True
@@ -594,334 +2274,82 @@ class Painter(tk.Frame):
     def draw_start(self, event):
         self.start_x = event.x
         self.start_y = event.y
-
-        if self.mode in ["pen", "eraser"]:
-            paint_color = self.color if self.mode == "pen" else self.bg_color
-            self.items.append(
-                self.c.create_line(
-                    self.start_x,
-                    self.start_y,
-                    event.x,
-                    event.y,
-                    width=self.line_width,
-                    fill=paint_color,
-                    capstyle=tk.ROUND,
-                    smooth=tk.TRUE,
-                    splinesteps=36,
-                    tags = "manual-start",
-                )
-            )
-        if self.mode == "text":
-            self.items.append(
-                self.c.create_text(event.x, event.y, text=self.text_input.get(), fill=self.color, font=self.font)
-            )
+        self.tool.start(self, event)
 
     def draw_motion(self, event):
-        if self.mode in ["pen", "eraser"]:
-            paint_color = self.color if self.mode == "pen" else self.bg_color
-            self.items.append(
-                self.c.create_line(
-                    self.start_x,
-                    self.start_y,
-                    event.x,
-                    event.y,
-                    width=self.line_width,
-                    fill=paint_color,
-                    capstyle=tk.ROUND,
-                    smooth=tk.TRUE,
-                    splinesteps=36,
-                    tags = "manual",
-                )
-            )
-            self.start_x = event.x
-            self.start_y = event.y
+        if self.pan_last is not None:
+            # Control was let go in the middle of panning
+            self.pan_motion(event)
+            return
+        self.tool.motion(self, event)
 
-        if self.mode == "rectangle":
-            if self.ghost:
-                self.c.delete(self.ghost)
-            if self.shift_pressed:
-                rect_x = event.x
-                rect_y = self.start_y - (self.start_x - event.x)
-                self.ghost = self.c.create_rectangle(
-                    self.start_x,
-                    self.start_y,
-                    rect_x,
-                    rect_y,
-                    outline=self.color,
-                    fill=self.fill_color,
-                    width=self.line_width,
-                )
-            elif self.alt_pressed:
-                radius = min(self.start_x - event.x, self.start_y - event.y)
-                rect_x = self.start_x + radius
-                rect_y = self.start_y + radius
-                start_x = self.start_x - radius
-                start_y = self.start_y - radius
-                self.ghost = self.c.create_rectangle(
-                    start_x, start_y, rect_x, rect_y, outline=self.color, fill=self.fill_color, width=self.line_width
-                )
-            else:
-                self.ghost = self.c.create_rectangle(
-                    self.start_x,
-                    self.start_y,
-                    event.x,
-                    event.y,
-                    outline=self.color,
-                    fill=self.fill_color,
-                    width=self.line_width,
-                )
+    def draw_release(self, event):
+        if self.pan_last is not None:
+            self.pan_end(event)
+            return
+        self.tool.release(self, event)
+        self.end_ink_batch()
+        self.reset(None)
 
-        if self.mode == "ellipse":
-            if self.ghost:
-                self.c.delete(self.ghost)
-            if self.shift_pressed:
-                rect_x = event.x
-                rect_y = self.start_y - (self.start_x - event.x)
-                self.ghost = self.c.create_oval(
-                    self.start_x,
-                    self.start_y,
-                    rect_x,
-                    rect_y,
-                    outline=self.color,
-                    fill=self.fill_color,
-                    width=self.line_width,
-                )
-            elif self.alt_pressed:
-                radius = math.sqrt(((self.start_x - event.x) ** 2) + ((self.start_y - event.y) ** 2))
-                rect_x = self.start_x + radius
-                rect_y = self.start_y + radius
-                start_x = self.start_x - radius
-                start_y = self.start_y - radius
-                self.ghost = self.c.create_oval(
-                    start_x, start_y, rect_x, rect_y, outline=self.color, fill=self.fill_color, width=self.line_width
-                )
-            else:
-                self.ghost = self.c.create_oval(
-                    self.start_x,
-                    self.start_y,
-                    event.x,
-                    event.y,
-                    outline=self.color,
-                    fill=self.fill_color,
-                    width=self.line_width,
-                )
+    def merge_stroke(self, color):
+        # The segments drawn live become a single polyline, far cheaper for Tk to redraw
+        stroke = self.stroke
+        if len(stroke.items) < 2:
+            return
+        self.c.delete(*stroke.items)
+        segments = [self.items.pop(item) for item in stroke.items if item in self.items]
+        for item in stroke.items:
+            self.unindex(item)
+        self.log("delete", segments)
+        # No spline: the stroke keeps the exact shape it had while being drawn
+        points = stroke.simplify()
+        if len(points) == 1:
+            points = points * 2
+        self.create(
+            "line",
+            *[coord for point in points for coord in point],
+            width=self.line_width,
+            fill=color,
+            capstyle=tk.ROUND,
+            joinstyle=tk.ROUND,
+            tags=self.item_tags("manual-start"),
+        )
 
-        if self.mode == "arrow":
-            if self.ghost:
-                self.c.delete(self.ghost)
-
-            tip1 = (
-                event.x
-                + (
-                    0.2
-                    * (
-                        ((self.start_x - event.x) * math.cos(math.pi / 6))
-                        + ((self.start_y - event.y) * math.sin(math.pi / 6))
-                    )
-                ),
-                event.y
-                + (
-                    0.2
-                    * (
-                        ((self.start_y - event.y) * math.cos(math.pi / 6))
-                        - ((self.start_x - event.x) * math.sin(math.pi / 6))
-                    )
-                ),
-            )
-            tip2 = (
-                event.x
-                + (
-                    0.2
-                    * (
-                        ((self.start_x - event.x) * math.cos(math.pi / 6))
-                        - ((self.start_y - event.y) * math.sin(math.pi / 6))
-                    )
-                ),
-                event.y
-                + (
-                    0.2
-                    * (
-                        ((self.start_y - event.y) * math.cos(math.pi / 6))
-                        + ((self.start_x - event.x) * math.sin(math.pi / 6))
-                    )
-                ),
+    def recognize_stroke(self):
+        shape = self.stroke.classify()
+        if shape is None:
+            return None
+        kind, coords = shape
+        self.c.delete(*self.stroke.items)
+        raw = [self.items.pop(item) for item in self.stroke.items if item in self.items]
+        for item in self.stroke.items:
+            self.unindex(item)
+        self.log("delete", raw)
+        tags = self.item_tags("recognized")
+        if kind == "line":
+            item = self.create(
+                "line", *coords, width=self.line_width, fill=self.color, capstyle=tk.ROUND, tags=tags
             )
-            self.ghost = self.c.create_polygon(
-                self.start_x,
-                self.start_y,
-                event.x,
-                event.y,
-                tip1[0],
-                tip1[1],
-                event.x,
-                event.y,
-                tip2[0],
-                tip2[1],
-                event.x,
-                event.y,
+        elif kind == "arrow":
+            item = self.create(
+                "polygon",
+                *self.arrow_coords(*coords),
                 outline=self.color,
                 fill=self.fill_color,
                 width=self.line_width,
+                tags=tags,
             )
-
-    def draw_release(self, event):
-        if self.mode == "rectangle":
-            if self.shift_pressed:
-                rect_x = event.x
-                rect_y = self.start_y - (self.start_x - event.x)
-                self.items.append(
-                    self.c.create_rectangle(
-                        self.start_x,
-                        self.start_y,
-                        rect_x,
-                        rect_y,
-                        outline=self.color,
-                        fill=self.fill_color,
-                        width=self.line_width,
-                    )
-                )
-            elif self.alt_pressed:
-                radius = min(self.start_x - event.x, self.start_y - event.y)
-                rect_x = self.start_x + radius
-                rect_y = self.start_y + radius
-                start_x = self.start_x - radius
-                start_y = self.start_y - radius
-                self.items.append(
-                    self.c.create_rectangle(
-                        start_x,
-                        start_y,
-                        rect_x,
-                        rect_y,
-                        outline=self.color,
-                        fill=self.fill_color,
-                        width=self.line_width,
-                    )
-                )
-            else:
-                self.items.append(
-                    self.c.create_rectangle(
-                        self.start_x,
-                        self.start_y,
-                        event.x,
-                        event.y,
-                        outline=self.color,
-                        fill=self.fill_color,
-                        width=self.line_width,
-                    )
-                )
-
-        if self.mode == "ellipse":
-            if self.shift_pressed:
-                rect_x = event.x
-                rect_y = self.start_y - (self.start_x - event.x)
-                self.items.append(
-                    self.c.create_oval(
-                        self.start_x,
-                        self.start_y,
-                        rect_x,
-                        rect_y,
-                        outline=self.color,
-                        fill=self.fill_color,
-                        width=self.line_width,
-                    )
-                )
-            elif self.alt_pressed:
-                radius = math.sqrt(((self.start_x - event.x) ** 2) + ((self.start_y - event.y) ** 2))
-                rect_x = self.start_x + radius
-                rect_y = self.start_y + radius
-                start_x = self.start_x - radius
-                start_y = self.start_y - radius
-                self.items.append(
-                    self.c.create_oval(
-                        start_x,
-                        start_y,
-                        rect_x,
-                        rect_y,
-                        outline=self.color,
-                        fill=self.fill_color,
-                        width=self.line_width,
-                    )
-                )
-            else:
-                self.items.append(
-                    self.c.create_oval(
-                        self.start_x,
-                        self.start_y,
-                        event.x,
-                        event.y,
-                        outline=self.color,
-                        fill=self.fill_color,
-                        width=self.line_width,
-                    )
-                )
-
-        if self.mode == "text" and not self.letter_capture:
-            self.mode = "pen"
-            self.status_bar.update_status(mode=self.mode)
-            self.menu_bar.update_status(mode=self.mode)
-
-        if self.mode == "arrow":
-            tip1 = (
-                event.x
-                + (
-                    0.2
-                    * (
-                        ((self.start_x - event.x) * math.cos(math.pi / 6))
-                        + ((self.start_y - event.y) * math.sin(math.pi / 6))
-                    )
-                ),
-                event.y
-                + (
-                    0.2
-                    * (
-                        ((self.start_y - event.y) * math.cos(math.pi / 6))
-                        - ((self.start_x - event.x) * math.sin(math.pi / 6))
-                    )
-                ),
-            )
-            tip2 = (
-                event.x
-                + (
-                    0.2
-                    * (
-                        ((self.start_x - event.x) * math.cos(math.pi / 6))
-                        - ((self.start_y - event.y) * math.sin(math.pi / 6))
-                    )
-                ),
-                event.y
-                + (
-                    0.2
-                    * (
-                        ((self.start_y - event.y) * math.cos(math.pi / 6))
-                        + ((self.start_x - event.x) * math.sin(math.pi / 6))
-                    )
-                ),
-            )
-            self.items.append(
-                self.c.create_polygon(
-                    self.start_x,
-                    self.start_y,
-                    event.x,
-                    event.y,
-                    tip1[0],
-                    tip1[1],
-                    event.x,
-                    event.y,
-                    tip2[0],
-                    tip2[1],
-                    event.x,
-                    event.y,
-                    outline=self.color,
-                    fill=self.fill_color,
-                    width=self.line_width,
-                )
+        else:
+            item = self.create(
+                kind, *coords, outline=self.color, fill=self.fill_color, width=self.line_width, tags=tags
             )
-
-        self.reset(None)
+        self.raw_strokes[id(self.items[item])] = (self.items[item], raw)
+        return kind
 
     def draw_line_start(self, event):
         self.start_x = event.x
         self.start_y = event.y
+        self.begin_stroke()
 
     def draw_line_motion(self, event):
         if self.ghost:
@@ -934,29 +2362,324 @@ class Painter(tk.Frame):
             width=self.line_width,
             fill=self.color,
             capstyle=tk.ROUND,
-            smooth=tk.TRUE,
-            splinesteps=36,
         )
 
     def draw_line_release(self, event):
-        self.items.append(
-            self.c.create_line(
-                self.start_x,
-                self.start_y,
-                event.x,
-                event.y,
-                width=self.line_width,
-                fill=self.color,
-                capstyle=tk.ROUND,
-                smooth=tk.TRUE,
-                splinesteps=36,
-            )
+        self.create(
+            "line",
+            self.start_x,
+            self.start_y,
+            event.x,
+            event.y,
+            width=self.line_width,
+            fill=self.color,
+            capstyle=tk.ROUND,
+            tags=self.item_tags(),
         )
+        self.end_ink_batch()
         self.reset(None)
 
 
+def parse_color(color):
+    # Tk style "#rgb", "#rrggbb" or "#rrrrggggbbbb" colours, as RGB bytes
+    if not color:
+        return None
+    if not color.startswith("#"):
+        return {"white": b"\xff\xff\xff"}.get(color.lower(), b"\x00\x00\x00")
+    digits = (len(color) - 1) // 3
+    # The two high digits of each channel, "#rgb" digits being doubled
+    channels = (color[1 + idx * digits:1 + idx * digits + min(digits, 2)] for idx in range(3))
+    return bytes(int(channel * (2 // len(channel)), 16) for channel in channels)
+
+
+def png_bytes(width, height, pixels):
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    stride = width * 3
+    raw = b"".join(b"\x00" + pixels[row:row + stride] for row in range(0, stride * height, stride))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b"")
+
+
+class Raster:
+    """RGB frame buffer drawing the canvas items without Tk, one scanline span at a time."""
+
+    def __init__(self, width, height, background):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(parse_color(background) * (width * height))
+
+    def span(self, y, x0, x1, rgb):
+        if not 0 <= y < self.height:
+            return
+        start = max(0, int(math.ceil(x0 - 0.5)))
+        end = min(self.width, int(math.floor(x1 - 0.5)) + 1)
+        if end > start:
+            row = y * self.width * 3
+            self.pixels[row + start * 3:row + end * 3] = rgb * (end - start)
+
+    def rows(self, top, bottom):
+        return range(max(0, int(top)), min(self.height - 1, int(bottom)) + 1)
+
+    def polygon(self, points, rgb):
+        count = len(points)
+        for y in self.rows(min(p[1] for p in points), max(p[1] for p in points)):
+            cy = y + 0.5
+            xs = []
+            for idx in range(count):
+                (x0, y0), (x1, y1) = points[idx], points[(idx + 1) % count]
+                if (y0 <= cy < y1) or (y1 <= cy < y0):
+                    xs.append(x0 + (cy - y0) * (x1 - x0) / (y1 - y0))
+            xs.sort()
+            for idx in range(0, len(xs) - 1, 2):
+                self.span(y, xs[idx], xs[idx + 1], rgb)
+
+    def ellipse(self, cx, cy, rx, ry, rgb, inner_rx=0.0, inner_ry=0.0):
+        for y in self.rows(cy - ry, cy + ry):
+            dy = y + 0.5 - cy
+            if rx <= 0 or ry <= 0 or abs(dy) > ry:
+                continue
+            dx = rx * math.sqrt(1 - (dy / ry) ** 2)
+            if inner_rx > 0 and abs(dy) < inner_ry:
+                ix = inner_rx * math.sqrt(1 - (dy / inner_ry) ** 2)
+                self.span(y, cx - dx, cx - ix, rgb)
+                self.span(y, cx + ix, cx + dx, rgb)
+            else:
+                self.span(y, cx - dx, cx + dx, rgb)
+
+    def segment(self, x0, y0, x1, y1, width, rgb, round_caps=True):
+        radius = max(width, 1.0) / 2
+        length = math.hypot(x1 - x0, y1 - y0)
+        if length:
+            ux, uy = (x1 - x0) / length, (y1 - y0) / length
+            if not round_caps:
+                x0, y0, x1, y1 = x0 - ux * radius, y0 - uy * radius, x1 + ux * radius, y1 + uy * radius
+            nx, ny = -uy * radius, ux * radius
+            self.polygon([(x0 + nx, y0 + ny), (x1 + nx, y1 + ny), (x1 - nx, y1 - ny), (x0 - nx, y0 - ny)], rgb)
+        if round_caps:
+            self.ellipse(x0, y0, radius, radius, rgb)
+            self.ellipse(x1, y1, radius, radius, rgb)
+
+    def draw(self, kind, coords, options, sx, sy):
+        # Smoothing, stipples, text and images are not rendered
+        points = [(coords[idx] * sx, coords[idx + 1] * sy) for idx in range(0, len(coords) - 1, 2)]
+        width = float(options.get("width", 1)) * (sx + sy) / 2
+        if kind == "line":
+            rgb = parse_color(options.get("fill", "black"))
+            if rgb:
+                for (x0, y0), (x1, y1) in zip(points, points[1:]):
+                    self.segment(x0, y0, x1, y1, width, rgb)
+        elif kind in ["rectangle", "oval"]:
+            (x0, y0), (x1, y1) = points
+            x0, x1, y0, y1 = min(x0, x1), max(x0, x1), min(y0, y1), max(y0, y1)
+            fill = parse_color(options.get("fill", ""))
+            outline = parse_color(options.get("outline", "black"))
+            if kind == "rectangle":
+                if fill:
+                    for y in self.rows(y0, y1):
+                        self.span(y, x0, x1, fill)
+                if outline:
+                    for (ax, ay), (bx, by) in [((x0, y0), (x1, y0)), ((x1, y0), (x1, y1)), ((x1, y1), (x0, y1)), ((x0, y1), (x0, y0))]:
+                        self.segment(ax, ay, bx, by, width, outline, round_caps=False)
+            else:
+                cx, cy, rx, ry = (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2, (y1 - y0) / 2
+                if fill:
+                    self.ellipse(cx, cy, rx, ry, fill)
+                if outline:
+                    self.ellipse(cx, cy, rx + width / 2, ry + width / 2, outline, rx - width / 2, ry - width / 2)
+        elif kind == "polygon":
+            fill = parse_color(options.get("fill", "black"))
+            outline = parse_color(options.get("outline", ""))
+            if fill:
+                self.polygon(points, fill)
+            if outline:
+                for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+                    self.segment(x0, y0, x1, y1, width, outline)
+
+
+class TimelapseScene:
+    """State of a recorded session after replaying its first `next` events."""
+
+    def __init__(self, background):
+        self.next = 0
+        self.count = 0
+        self.page = 0
+        self.pages = {0: {}}
+        self.background = background
+        self.hidden = set()
+        # Highest layer drawn on each page, to know when an addition lands below other items
+        self.top = {0: 0}
+
+    def copy(self):
+        other = TimelapseScene(self.background)
+        other.__dict__.update(self.__dict__)
+        other.pages = {page: dict(items) for page, items in self.pages.items()}
+        other.hidden = set(self.hidden)
+        other.top = dict(self.top)
+        return other
+
+    def apply(self, event):
+        # Returns the added item when it can be painted on top of the previous frame
+        live = self.pages[self.page]
+        self.next += 1
+        if event[1] == "add":
+            item = event[2:]
+            live[self.count] = item
+            self.count += 1
+            layer = layer_number(item)
+            if layer < self.top[self.page]:
+                # Goes under the items of an upper layer: the frame is drawn again
+                return None
+            self.top[self.page] = layer
+            return item
+        if event[1] == "delete":
+            for number in event[2]:
+                live.pop(number, None)
+        elif event[1] == "update":
+            for number, kind, coords, options in event[2]:
+                if number in live:
+                    live[number] = (kind, coords, options)
+        elif event[1] == "wipe":
+            live.clear()
+            self.top[self.page] = 0
+        elif event[1] == "clear":
+            for number in [number for number, item in live.items() if event[2] in item[2].get("tags", [])]:
+                del live[number]
+        elif event[1] == "page":
+            # Disappearing ink does not survive a page switch
+            for number in [number for number, item in live.items() if any(tag.startswith("ink") for tag in item[2].get("tags", []))]:
+                del live[number]
+            self.page = event[2]
+            self.pages.setdefault(self.page, {})
+            self.top.setdefault(self.page, 0)
+        elif event[1] == "background":
+            self.background = event[2]
+        elif event[1] == "hide":
+            self.hidden.add(event[2])
+        elif event[1] == "show":
+            self.hidden.discard(event[2])
+        return None
+
+    def visible(self, item):
+        return not self.hidden.intersection(item[2].get("tags", []))
+
+    def stacked(self):
+        # Items of the current page bottom to top: by layer, then in drawing order
+        live = self.pages[self.page]
+        return [live[number] for number in sorted(live, key=lambda number: (layer_number(live[number]), number))]
+
+
+def layer_number(item):
+    for tag in item[2].get("tags", []):
+        if tag.startswith("layer") and tag[5:].isdigit():
+            return int(tag[5:])
+    return 0
+
+
+TIMELAPSE = {}
+
+
+def timelapse_init(session_path, out_dir, fps, speed, size):
+    session = json.load(open(session_path))
+    TIMELAPSE.update(
+        events=session["events"],
+        out_dir=out_dir,
+        fps=fps,
+        speed=speed,
+        size=size,
+        scale=(size[0] / max(session["size"][0], 1), size[1] / max(session["size"][1], 1)),
+    )
+
+
+def timelapse_render(task):
+    # Render frames [first, last) starting from a checkpoint, drawing additions incrementally
+    scene, first, last = task
+    events = TIMELAPSE["events"]
+    width, height = TIMELAPSE["size"]
+    sx, sy = TIMELAPSE["scale"]
+    raster = None
+    for frame in range(first, last):
+        now = frame * TIMELAPSE["speed"] / TIMELAPSE["fps"]
+        added = []
+        while scene.next < len(events) and events[scene.next][0] <= now:
+            item = scene.apply(events[scene.next])
+            if item is None:
+                raster = None
+            else:
+                added.append(item)
+        if raster is None:
+            raster = Raster(width, height, scene.background)
+            added = scene.stacked()
+        for item in added:
+            if scene.visible(item):
+                raster.draw(item[0], item[1], item[2], sx, sy)
+        path = os.path.join(TIMELAPSE["out_dir"], "frame_{:06d}.png".format(frame))
+        with open(path, "wb") as output:
+            output.write(png_bytes(width, height, raster.pixels))
+    return last - first
+
+
+def export_timelapse(session_path, out_dir, fps=30, speed=10.0, size=None, jobs=None, checkpoint_every=1000):
+    # Only needed for exporting, not worth slowing down the painter startup
+    import concurrent.futures
+
+    session = json.load(open(session_path))
+    events = session["events"]
+    size = size or session["size"]
+    frames = int((events[-1][0] if events else 0) / speed * fps) + 1
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Replay the history once, keeping a copy of the scene every few events
+    scene = TimelapseScene(DEFAULT["background"])
+    checkpoints = [scene.copy()]
+    for event in events:
+        scene.apply(event)
+        if scene.next % checkpoint_every == 0:
+            checkpoints.append(scene.copy())
+
+    jobs = jobs or os.cpu_count() or 1
+    chunk = max(1, -(-frames // (jobs * 4)))
+    tasks = []
+    for first in range(0, frames, chunk):
+        now = first * speed / fps
+        start = checkpoints[0]
+        for checkpoint in checkpoints:
+            if checkpoint.next and events[checkpoint.next - 1][0] > now:
+                break
+            start = checkpoint
+        tasks.append((start, first, min(frames, first + chunk)))
+
+    with concurrent.futures.ProcessPoolExecutor(
+        jobs, initializer=timelapse_init, initargs=(session_path, out_dir, fps, speed, size)
+    ) as pool:
+        done = 0
+        for count in pool.map(timelapse_render, tasks):
+            done += count
+            print("\r{}/{} frames".format(done, frames), end="", flush=True)
+    print()
+
 
 if __name__ == "__main__":
-    root = tk.Tk()
-    Painter(root)
-    root.mainloop()
+    import argparse
+    import multiprocessing
+    import sys
+    # Plugin tools "import painter": they must get this module, not a second copy with its own queue
+    sys.modules.setdefault("painter", sys.modules[__name__])
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Draw on stream telestrator")
+    parser.add_argument("--startup-time", action="store_true", help="print the startup timings and quit")
+    parser.add_argument("--timelapse", metavar="SESSION", help="export a saved session as PNG frames")
+    parser.add_argument("--out", default="timelapse", help="directory of the exported frames")
+    parser.add_argument("--fps", type=int, default=30, help="frames per second of the timelapse")
+    parser.add_argument("--speed", type=float, default=10.0, help="how many times faster than the session")
+    parser.add_argument("--size", help="size of the frames, as WIDTHxHEIGHT")
+    parser.add_argument("--jobs", type=int, help="number of rendering processes")
+    args = parser.parse_args()
+    if args.timelapse:
+        size = tuple(int(x) for x in args.size.split("x")) if args.size else None
+        export_timelapse(args.timelapse, args.out, args.fps, args.speed, size, args.jobs)
+    else:
+        root = tk.Tk()
+        Painter(root, measure_startup=args.startup_time)
+        root.mainloop()